@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for bin/route_monitoring.py
+#   Generates synthetic Inca/Nagios TestResult documents and drives Router through its
+#   {file, directory, amqp} sources and {print, directory, api, warehouse} destinations
+#   using local stand-ins only: an in-process fake AMQP connection, a local HTTP server
+#   for the API, and SQLite (or DJANGO_SETTINGS_MODULE's database) for the warehouse.
+#   Each scenario runs in a forked child so its peak RSS is measured on its own.
+import argparse
+import contextlib
+from datetime import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep, time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+DEFAULT_SCENARIOS = ['file:print', 'directory:print', 'directory:api', 'directory:warehouse',
+                     'amqp:print', 'amqp:directory', 'amqp:api', 'amqp:warehouse']
+
+########## Synthetic traffic ##########
+
+def make_documents(count, resources, tests, size, inca_fraction, seed=0):
+    # Returns [(doctype, resourceid, body)] with bodies padded to roughly size bytes
+    rand = random.Random(seed)
+    padding = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz0123456789 ') for i in range(max(size, 0)))
+    docs = []
+    for i in range(count):
+        doctype = 'inca' if rand.random() < inca_fraction else 'nagios'
+        resourceid = 'resource{}.xsede.org'.format(rand.randrange(resources))
+        test = '{}-test{}'.format(doctype, rand.randrange(tests))
+        result = {
+            'ID': 'urn:glue2:TestResult:{}:{}:{}'.format(doctype, resourceid, test),
+            'Name': test,
+            'CreationTime': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'Validity': 86400,
+            'Result': rand.choice(['pass', 'pass', 'pass', 'fail']),
+            'ErrorMessage': None,
+            'Associations': {'ResourceID': resourceid},
+            'Extension': {'Source': doctype.capitalize()},
+        }
+        body = json.dumps({'TestResult': result})
+        pad = size - len(body)
+        if pad > 0:
+            # Inca reports carry a large report body, Nagios a plugin output string
+            field = 'Report' if doctype == 'inca' else 'Output'
+            result['Extension'][field] = padding[:pad]
+            body = json.dumps({'TestResult': result})
+        docs.append((doctype, resourceid, body))
+    return docs
+
+def write_documents(docs, top):
+    # Lay documents out like the directory destination does: <exchange>/<routing_key>.<timestamp>
+    paths = []
+    for (idx, (doctype, resourceid, body)) in enumerate(docs):
+        dir = os.path.join(top, doctype)
+        os.makedirs(dir, exist_ok=True)
+        path = os.path.join(dir, '{}.{:08d}'.format(resourceid, idx))
+        with open(path, 'w') as file:
+            file.write(body)
+        paths.append(path)
+    return paths
+
+########## Stand-ins ##########
+
+class BenchDone(BaseException):
+    # Raised out of drain_events to stop Router.Run once every message is acknowledged
+    pass
+
+class FakeMessage():
+    def __init__(self, tag, exchange, routing_key, body):
+        self.delivery_tag = tag
+        self.delivery_info = {'exchange': exchange, 'routing_key': routing_key}
+        self.body = body
+
+class FakeChannel():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, a_global=False):
+        self.conn.prefetch = prefetch_count or len(self.conn.docs)
+        self.conn.signal()
+
+    def queue_declare(self, queue, **kwargs):
+        return argparse.Namespace(queue=queue, message_count=0, consumer_count=0)
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def queue_unbind(self, *args, **kwargs):
+        pass
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def exchange_bind(self, *args, **kwargs):
+        pass
+
+    def exchange_unbind(self, *args, **kwargs):
+        pass
+
+    def basic_consume(self, queue, callback=None, **kwargs):
+        self.conn.callback = callback
+        self.conn.signal()
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.conn.ack(delivery_tag, multiple)
+
+    def close(self):
+        pass
+
+class FakeConnection():
+    # Delivers the documents like a broker would, honouring prefetch, and records per-message latency
+    #   sock is one end of a socketpair kept readable while a delivery is possible, or once every
+    #   document is acknowledged, so engines that wait on the socket see the same as with a broker
+    def __init__(self, docs, timeout=60):
+        self.docs = docs
+        self.next = 0
+        self.prefetch = len(docs)
+        self.delivered = {}     # tag -> delivery time
+        self.latencies = []
+        self.deadline = time() + timeout
+        self.finished = None    # When the last document was acknowledged
+        self.lock = threading.Lock()
+        self.callback = None
+        (self.sock, self.peer) = socket.socketpair()
+        self.sock.setblocking(False)
+        self.signalled = False
+
+    def connect(self):
+        pass
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def done(self):
+        return (self.next >= len(self.docs) and not self.delivered) or time() > self.deadline
+
+    def deliverable(self):
+        return self.callback and self.next < len(self.docs) and len(self.delivered) < self.prefetch
+
+    def signal(self):
+        with self.lock:
+            if not self.signalled and (self.deliverable() or self.done()):
+                self.peer.send(b'x')
+                self.signalled = True
+
+    def ack(self, delivery_tag, multiple):
+        now = time()
+        with self.lock:
+            tags = [tag for tag in self.delivered if tag <= delivery_tag] if multiple else [delivery_tag]
+            for tag in tags:
+                self.latencies.append(now - self.delivered.pop(tag))
+            if self.next >= len(self.docs) and not self.delivered:
+                self.finished = now
+        self.signal()
+
+    def drain_events(self, timeout=None):
+        with self.lock:
+            if self.signalled:
+                self.sock.recv(1)
+                self.signalled = False
+            (done, deliverable) = (self.done(), self.deliverable())
+        if done and timeout:
+            raise BenchDone()
+        if deliverable:
+            (doctype, resourceid, body) = self.docs[self.next]
+            self.next += 1
+            with self.lock:
+                self.delivered[self.next] = time()
+            self.callback(FakeMessage(self.next, doctype, resourceid, body))
+            self.signal()
+            return
+        if timeout:
+            sleep(min(timeout, 0.01))
+        raise socket.timeout()
+
+    def heartbeat_tick(self):
+        # Housekeeping runs this on every engine, so it ends non-blocking (timeout=0) consumers too
+        if self.done():
+            raise BenchDone()
+
+    def close(self):
+        pass
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+def start_api_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def setup_django(workdir, apps):
+    # Use the caller's DJANGO_SETTINGS_MODULE if set, otherwise a throwaway SQLite warehouse
+    import django
+    from django.conf import settings
+    if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        settings.configure(
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'HOST': 'sqlite',
+                                   'NAME': os.path.join(workdir, 'warehouse.sqlite3')}},
+            INSTALLED_APPS=apps, USE_TZ=True, SECRET_KEY='route_monitoring_bench')
+        django.setup()
+        from django.core.management import call_command
+        call_command('migrate', run_syncdb=True, verbosity=0)
+    else:
+        django.setup()
+
+########## Scenarios ##########
+
+def measure_startup(dest, options, workdir):
+    # Wall-clock seconds for fresh router processes to replay one document, module import included
+    rundir = tempfile.mkdtemp(prefix='startup-{}-'.format(dest), dir=workdir)
+    config = {'LOG_FILE': os.path.join(rundir, 'route_monitoring.log'), 'LOG_LEVEL': options.log_level,
+              'PID_FILE': os.path.join(rundir, 'route_monitoring.pid'),
+              'API_USERID': 'bench', 'API_PASSWORD': 'bench', 'X509_CERT': '', 'X509_KEY': ''}
+    config.update(options.config)
+    conf_path = os.path.join(rundir, 'route_monitoring.conf')
+    with open(conf_path, 'w') as file:
+        json.dump(config, file)
+    dest_arg = dest
+    if dest == 'api':
+        server = start_api_server()
+        dest_arg = 'api:127.0.0.1:{}'.format(server.server_address[1])
+    command = [sys.executable, os.path.join(BIN_DIR, 'route_monitoring.py'), '-c', conf_path,
+               '-s', 'file:' + options.paths[0], '-d', dest_arg] + options.router_args
+    seconds = []
+    for run in range(options.startup):
+        start = time()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        seconds.append(time() - start)
+    if dest == 'api':
+        server.shutdown()
+    return {'scenario': 'startup:' + dest, 'runs': len(seconds),
+            'min_s': min(seconds), 'median_s': statistics.median(seconds), 'max_s': max(seconds)}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def run_scenario(scenario, docs, options, workdir):
+    # Runs in a forked child; returns a result dict
+    (src, dest) = scenario.split(':')
+    if src != 'amqp' and dest == 'directory':
+        return {'scenario': scenario, 'skipped': 'the router does not route file/directory to directory'}
+    sys.path.insert(0, BIN_DIR)
+    import route_monitoring
+
+    rundir = tempfile.mkdtemp(prefix='{}-{}-'.format(src, dest), dir=workdir)
+    config = {'LOG_FILE': os.path.join(rundir, 'route_monitoring.log'), 'LOG_LEVEL': options.log_level,
+              'PID_FILE': os.path.join(rundir, 'route_monitoring.pid'), 'RUN_DIR': rundir,
+              'API_USERID': 'bench', 'API_PASSWORD': 'bench', 'X509_CERT': '', 'X509_KEY': ''}
+    config.update(options.config)
+    conf_path = os.path.join(rundir, 'route_monitoring.conf')
+    with open(conf_path, 'w') as file:
+        json.dump(config, file)
+
+    if dest == 'api':
+        server = start_api_server()
+        dest_arg = 'api:127.0.0.1:{}'.format(server.server_address[1])
+    elif dest == 'directory':
+        dest_arg = 'directory:' + os.path.join(rundir, 'out')
+        for doctype in ['inca', 'nagios']:
+            os.makedirs(os.path.join(rundir, 'out', doctype))
+    else:
+        dest_arg = dest
+    src_arg = 'amqp:localhost:5671' if src == 'amqp' else '{}:{}'.format(src, os.path.join(workdir, 'docs'))
+
+    sys.argv = ['route_monitoring.py', '-c', conf_path, '-s', src_arg, '-d', dest_arg] + options.router_args
+    router = route_monitoring.Router()
+    latencies = []
+    end = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        router.Setup()
+        start = time()
+        if src == 'amqp':
+            conn = FakeConnection(docs, timeout=options.timeout)
+            router.ConnectAmqp_UserPass = lambda: conn
+            try:
+                router.Run()
+            except BenchDone:
+                pass
+            latencies = conn.latencies
+            # Up to the last acknowledgement, not until the engine notices, up to a housekeeping interval later
+            end = conn.finished
+        else:
+            process_file = router.process_file
+            def timed_process_file(path):
+                file_start = time()
+                process_file(path)
+                latencies.append(time() - file_start)
+            router.process_file = timed_process_file
+            if src == 'file':
+                for path in options.paths:
+                    router.src['obj'] = path
+                    router.Run()
+            else:
+                router.Run()
+        elapsed = (end or time()) - start
+
+    return {'scenario': scenario, 'messages': len(docs), 'seconds': elapsed,
+            'msgs_per_s': len(docs) / elapsed if elapsed else None,
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+def scenario_child(conn, scenario, docs, options, workdir):
+    try:
+        result = run_scenario(scenario, docs, options, workdir)
+    except BaseException as e:
+        result = {'scenario': scenario, 'error': '{}: {}'.format(type(e).__name__, e)}
+    conn.send(result)
+    conn.close()
+
+def format_result(result):
+    if 'error' in result or 'skipped' in result:
+        return '{:<22} {}'.format(result['scenario'], result.get('error') or 'skipped, ' + result['skipped'])
+    if 'runs' in result:
+        return '{:<22} {:>8} runs, seconds min={:.3f} median={:.3f} max={:.3f}'.format(result['scenario'],
+            result['runs'], result['min_s'], result['median_s'], result['max_s'])
+    def num(value, fmt):
+        return fmt.format(value) if value is not None else '-'
+    return '{:<22} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(result['scenario'], result['messages'],
+        num(result['msgs_per_s'], '{:.1f}'), num(result['p50_ms'], '{:.3f}'), num(result['p99_ms'], '{:.3f}'),
+        num(result['peak_rss_mb'], '{:.1f}'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark route_monitoring.py with synthetic Inca/Nagios traffic')
+    parser.add_argument('scenarios', nargs='*', default=DEFAULT_SCENARIOS,
+                        help='<source>:<destination> pairs (default={})'.format(' '.join(DEFAULT_SCENARIOS)))
+    parser.add_argument('-n', '--messages', type=int, default=2000, help='Messages per scenario (default=2000)')
+    parser.add_argument('-r', '--resources', type=int, default=50, help='Distinct ResourceIDs (default=50)')
+    parser.add_argument('-t', '--tests', type=int, default=10, help='Distinct test names per doctype (default=10)')
+    parser.add_argument('-b', '--size', type=int, default=4096, help='Approximate message size in bytes (default=4096)')
+    parser.add_argument('--inca', type=float, default=0.5, help='Fraction of Inca messages (default=0.5)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default=0)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='Router configuration override, may be repeated (e.g. --set WORKERS=4)')
+    parser.add_argument('--router-args', default='', help='Extra router command line arguments')
+    parser.add_argument('--apps', default='monitoring_provider',
+                        help='Comma separated Django apps for the SQLite warehouse (default=monitoring_provider)')
+    parser.add_argument('--log-level', default='info', help='Router log level (default=info)')
+    parser.add_argument('--timeout', type=float, default=600, help='Per scenario timeout in seconds (default=600)')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='Also time RUNS fresh router processes per startup destination (default=0)')
+    parser.add_argument('--startup-dests', default='print,api',
+                        help='Comma separated startup destinations, warehouse needs DJANGO_SETTINGS_MODULE (default=print,api)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    options = parser.parse_args()
+
+    options.config = {}
+    for item in options.set:
+        (key, value) = item.split('=', 1)
+        try:
+            options.config[key] = json.loads(value)
+        except ValueError:
+            options.config[key] = value
+    options.router_args = options.router_args.split()
+
+    workdir = tempfile.mkdtemp(prefix='route_monitoring_bench-')
+    try:
+        docs = make_documents(options.messages, options.resources, options.tests, options.size, options.inca, options.seed)
+        options.paths = write_documents(docs, os.path.join(workdir, 'docs'))
+        # route_monitoring.py initializes Django on its own only for the warehouse destination or --expire
+        if any(scenario.endswith(':warehouse') for scenario in options.scenarios) or '--expire' in options.router_args:
+            setup_django(workdir, [app for app in options.apps.split(',') if app])
+
+        if not options.json:
+            print('messages={} resources={} tests={} size={} inca={}'.format(options.messages, options.resources,
+                  options.tests, options.size, options.inca))
+            print('{:<22} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('scenario', 'msgs', 'msgs/s', 'p50 ms', 'p99 ms', 'rss MB'))
+        context = multiprocessing.get_context('fork')
+        for scenario in options.scenarios:
+            (parent_conn, child_conn) = context.Pipe()
+            child = context.Process(target=scenario_child, args=(child_conn, scenario, docs, options, workdir))
+            child.start()
+            if parent_conn.poll(options.timeout + 60):
+                result = parent_conn.recv()
+            else:
+                result = {'scenario': scenario, 'error': 'timed out'}
+                child.terminate()
+            child.join()
+            print(json.dumps(result) if options.json else format_result(result))
+            sys.stdout.flush()
+        if options.startup > 0:
+            for dest in [dest for dest in options.startup_dests.split(',') if dest]:
+                try:
+                    result = measure_startup(dest, options, workdir)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    result = {'scenario': 'startup:' + dest, 'error': '{}: {}'.format(type(e).__name__, e)}
+                print(json.dumps(result) if options.json else format_result(result))
+                sys.stdout.flush()
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,17 @@
 # Route Inca/Nagios GLUE2 messages
 #   from a source (amqp, file, directory)
 #   to a destination (print, directory, warehouse, api)
-import amqp
-import copy
+# amqp, asyncio, ctypes, http.server and multiprocessing are imported where they are used, so runs that
+#   don't need them, like file and directory replays, start without loading them
 import argparse
+import atexit
 import base64
+import collections
+import concurrent.futures
 import datetime
 from datetime import datetime
+import gzip
+import hashlib
 import http.client as httplib
 import json
 import logging
@@ -16,28 +21,1379 @@ import logging.handlers
 import os
 from pid import PidFile
 import pwd
+import queue
+import random
 import re
+import select
 import shutil
 import signal
 import socket
 import ssl
 from ssl import _create_unverified_context
+import struct
 import sys
-from time import sleep
+import threading
+from time import sleep, time
+import traceback
+import zlib
 
-import django
-django.setup()
-from django.conf import settings
-from monitoring_provider.process import Glue2ProcessRawMonitoring, StatsSummary, Glue2DeleteExpiredMonitoring
+try:
+    # Optional faster JSON decoder
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-import pdb
+# Django and the warehouse processing classes are only loaded by runs that use them, see load_warehouse()
+django = settings = db_connection = transaction = None
+Glue2ProcessRawMonitoring = StatsSummary = Glue2DeleteExpiredMonitoring = None
+
+def load_warehouse():
+    # Initialize Django and import the warehouse processing classes, once
+    global django, settings, db_connection, transaction
+    global Glue2ProcessRawMonitoring, StatsSummary, Glue2DeleteExpiredMonitoring
+    if django:
+        return
+    import django as _django
+    _django.setup()
+    from django.conf import settings
+    from django.db import connection as db_connection, transaction
+    from monitoring_provider.process import Glue2ProcessRawMonitoring, StatsSummary, Glue2DeleteExpiredMonitoring
+    django = _django
 
 # Used during initialization before loggin is enabled
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+class Metrics():
+    # In-process counters, gauges and latency histograms, rendered in Prometheus text format
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+    HELP = {
+        'route_messages_total': ('counter', 'Messages received by exchange and destination'),
+        'route_retries_total': ('counter', 'Destination delivery retries'),
+        'route_errors_total': ('counter', 'Errors by stage'),
+        'route_dropped_total': ('counter', 'Messages not delivered by reason'),
+        'route_dedup_total': ('counter', 'Dedup cache lookups by result (hit=unchanged and skipped)'),
+        'route_drain_seconds': ('histogram', 'AMQP drain_events calls that delivered a frame'),
+        'route_parse_seconds': ('histogram', 'Message body JSON parsing'),
+        'route_destination_seconds': ('histogram', 'Destination calls (per batch for the warehouse)'),
+        'route_ack_seconds': ('histogram', 'AMQP basic_ack calls'),
+        'route_expire_seconds': ('histogram', 'Expired record deletion passes'),
+        'route_startup_seconds': ('histogram', 'Router startup, from argument parsing until ready to route'),
+        'route_shard_restarts_total': ('counter', 'Shard consumer processes restarted by the supervisor'),
+        'route_lag_seconds': ('histogram', 'Report CreationTime to destination write'),
+        'route_sink_buffered': ('gauge', 'Messages waiting in a fan-out sink buffer'),
+        'route_log_sampled_total': ('counter', 'Per-message log records left out by sampling or rate limiting'),
+        'route_api_bytes_total': ('counter', 'API request body bytes sent by Content-Encoding'),
+        'route_quarantined_total': ('counter', 'Messages over MAX_MESSAGE_BYTES by exchange'),
+        'route_watch_lag_seconds': ('histogram', 'Watched file last write to processed'),
+        'route_amqp_connects_total': ('counter', 'AMQP connections made by broker (primary, fallback)'),
+        'route_amqp_connect_seconds': ('histogram', 'AMQP disconnect until consuming again'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.gauges = {}        # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [count per bucket..., +Inf count, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for idx, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[idx] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+
+    def render(self):
+        def labelstr(labels, extra=()):
+            items = ['{}="{}"'.format(k, str(v).replace('"', '\\"')) for (k, v) in labels + extra]
+            return '{' + ','.join(items) + '}' if items else ''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(value)) for (key, value) in self.histograms.items())
+        lines = []
+        described = set()
+        def describe(name):
+            if name not in described and name in self.HELP:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, self.HELP[name][1]))
+                lines.append('# TYPE {} {}'.format(name, self.HELP[name][0]))
+        for ((name, labels), value) in counters + gauges:
+            describe(name)
+            lines.append('{}{} {}'.format(name, labelstr(labels), value))
+        for ((name, labels), hist) in histograms:
+            describe(name)
+            for (idx, bound) in enumerate(self.BUCKETS):
+                lines.append('{}_bucket{} {}'.format(name, labelstr(labels, (('le', bound),)), hist[idx]))
+            lines.append('{}_bucket{} {}'.format(name, labelstr(labels, (('le', '+Inf'),)), hist[-2]))
+            lines.append('{}_sum{} {:.6f}'.format(name, labelstr(labels), hist[-1]))
+            lines.append('{}_count{} {}'.format(name, labelstr(labels), hist[-2]))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def serve_metrics(bind):
+    # Serve the metrics at http://<bind>/metrics from a daemon thread; raises OSError if bind is in use
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return
+
+    server = http.server.ThreadingHTTPServer(bind, MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+class MetricsFileThread(threading.Thread):
+    # Periodically replace a stats file with the current metrics
+    def __init__(self, path, interval=60):
+        super().__init__(name='metrics-file', daemon=True)
+        self.path = path
+        self.interval = interval
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                with open(self.path + '.new', 'w') as file:
+                    file.write(metrics.render())
+                os.replace(self.path + '.new', self.path)
+            except IOError as e:
+                logging.getLogger('DaemonLog').error('Writing metrics file {}: {}'.format(self.path, e))
+
+# Per-message INFO and DEBUG lines are logged here so they can be sampled; it propagates to DaemonLog
+MESSAGE_LOG = 'DaemonLog.messages'
+
+class LogSampler(logging.Filter):
+    # Keeps a fraction of per-message records, and at most limit of them per second; warnings and errors always pass
+    def __init__(self, rate=1.0, limit=0):
+        super().__init__()
+        self.rate = rate
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.second = 0
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.name != MESSAGE_LOG:
+            return True
+        # Sampled at random, since a message's lines come in a fixed sequence
+        keep = self.rate >= 1 or random.random() < self.rate
+        if keep and self.limit:
+            with self.lock:
+                second = int(time())
+                if second != self.second:
+                    (self.second, self.count) = (second, 0)
+                keep = self.count < self.limit
+                self.count += keep
+        if not keep:
+            metrics.inc('route_log_sampled_total')
+        return keep
+
+class JsonLogFormatter(logging.Formatter):
+    # One JSON object per line, with the exchange, routing_key and size of per-message records
+    FIELDS = ('exchange', 'routing_key', 'size')
+
+    def format(self, record):
+        entry = {'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z', \
+                 'level': record.levelname, 'message': record.getMessage()}
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Enqueue records as they are, so the message is formatted on the listener thread instead of the caller's
+    def prepare(self, record):
+        return record
+
+def report_lag(msg, destination):
+    # Observe the time from the report's CreationTime until it was written to the destination
+    test_result = msg.test_result()
+    created = test_result.get('CreationTime') if test_result else None
+    if not isinstance(created, str):
+        return
+    try:
+        created = datetime.fromisoformat(created.replace('Z', '+00:00'))
+    except ValueError:
+        return
+    if created.tzinfo:
+        created = created.replace(tzinfo=None) - created.utcoffset()
+    metrics.observe('route_lag_seconds', (datetime.utcnow() - created).total_seconds(), destination=destination)
+
+class Message():
+    # A routed message, created once and passed through classification and every destination
+    #   The body is parsed only the first time .data is used, and the result (or error) is kept
+    __slots__ = ('ts', 'doctype', 'resourceid', 'body', 'token', '_data')
+    _UNPARSED = object()
+
+    def __init__(self, ts, doctype, resourceid, body, token=None):
+        self.ts = ts
+        self.doctype = doctype
+        self.resourceid = resourceid
+        self.body = body
+        self.token = token          # DeliveryTracker token for AMQP messages, otherwise None
+        self._data = Message._UNPARSED
+
+    def copy(self, token=None):
+        # The same message with another delivery token, sharing the body if it's already parsed
+        other = Message(self.ts, self.doctype, self.resourceid, self.body, token=token)
+        other._data = self._data
+        return other
+
+    @property
+    def data(self):
+        # Raises ValueError if the body isn't valid JSON
+        if self._data is Message._UNPARSED:
+            start = time()
+            try:
+                self._data = json_loads(self.body)
+            except ValueError as e:
+                self._data = e
+                metrics.inc('route_errors_total', stage='parse')
+            metrics.observe('route_parse_seconds', time() - start)
+        if isinstance(self._data, ValueError):
+            raise self._data
+        return self._data
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    @property
+    def text(self):
+        # The body as str, for destinations that store text; AMQP and file bodies are otherwise kept as bytes
+        return self.body if isinstance(self.body, str) else self.body.decode('utf-8', errors='replace')
+
+    def test_result(self):
+        # The TestResult document, or None when the body isn't a TestResult
+        try:
+            result = self.data.get('TestResult')
+        except (ValueError, AttributeError):
+            return None
+        return result if isinstance(result, dict) else None
+
+class _SessionHTTPSConnection(httplib.HTTPSConnection):
+    # Resumes the pool's cached TLS session so reconnects skip the full handshake
+    def __init__(self, pool, *args, **kwargs):
+        self.pool = pool
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.pool.tls_session)
+
+class ApiConnectionPool():
+    # Long-lived keep-alive connections to the warehouse API
+    #   The SSL context, TLS session, and Basic auth header are built once and shared by every request
+    STALE_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest, ConnectionResetError, \
+                    ConnectionAbortedError, BrokenPipeError)
+
+    def __init__(self, host, port, config, size=4, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.auth_header = 'Basic %s' % base64.standard_b64encode( (config['API_USERID'] + ':' + config['API_PASSWORD']).encode() ).decode()
+        if port == '443':
+#            ssl_con = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, capath='/etc/grid-security/certificates/')
+#            ssl_con.load_default_certs()
+#            ssl_con.load_cert_chain('certkey.pem')
+            self.ssl_context = ssl._create_unverified_context(check_hostname=False, \
+                                                              certfile=config['X509_CERT'], keyfile=config['X509_KEY'])
+        else:
+            self.ssl_context = None
+        self.tls_session = None
+        # LIFO so the most recently used (least likely to have idled out) connection is reused first
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _new_connection(self):
+        if self.ssl_context:
+            return _SessionHTTPSConnection(self, self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, conn, method, url, body, headers):
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            if self.ssl_context and conn.sock:
+                # TLS 1.3 session tickets only arrive after the first read, so capture here rather than in connect()
+                self.tls_session = conn.sock.session
+            self._release(conn)
+        return (response.status, response.reason, data)
+
+    def request(self, method, url, body, headers=None):
+        all_headers = {'Content-type': 'application/json', 'Authorization': self.auth_header}
+        if headers:
+            all_headers.update(headers)
+        try:
+            conn = self.idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._new_connection()
+            reused = False
+        try:
+            try:
+                return self._request(conn, method, url, body, all_headers)
+            except self.STALE_ERRORS:
+                if not reused:
+                    raise
+                # The server closed an idle pooled connection, retry once on a fresh one
+                conn.close()
+                conn = self._new_connection()
+                return self._request(conn, method, url, body, all_headers)
+        except:
+            conn.close()
+            raise
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class WarehouseBatcher():
+    # Collects warehouse messages and writes them to the database in one transaction
+    #   A batch is flushed when it reaches max_count messages or its oldest message is max_seconds old.
+    #   on_commit(tokens) is called with the batch's delivery tokens only after the transaction commits.
+    def __init__(self, application, on_commit, max_count=50, max_seconds=2):
+        self.application = application
+        self.on_commit = on_commit
+        self.max_count = max(1, max_count)
+        self.max_seconds = max_seconds
+        self.logger = logging.getLogger('DaemonLog')
+        # Messages may be added from several worker threads
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # Forget pending messages, for example after the AMQP channel they were delivered on is lost
+        with self.lock:
+            self.pending = []
+            self.first_time = None
+
+    def add(self, msg):
+        with self.lock:
+            if not self.pending:
+                self.first_time = datetime.utcnow()
+            self.pending.append(msg)
+            if len(self.pending) >= self.max_count:
+                self.flush()
+
+    def due(self):
+        return self.pending and (datetime.utcnow() - self.first_time).total_seconds() >= self.max_seconds
+
+    def seconds_until_due(self):
+        if not self.pending:
+            return self.max_seconds
+        return max(0, self.max_seconds - (datetime.utcnow() - self.first_time).total_seconds())
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        batch = self.pending
+        self.reset()
+        self.write(batch)
+        self.on_commit([msg.token for msg in batch if msg.token is not None])
+
+    def write(self, batch, drop_failed=False):
+        # Write messages in one transaction; raises if they can't all be written
+        #   With drop_failed, a message that fails on its own is dropped instead, unless the database is unavailable
+        proc = Glue2ProcessRawMonitoring(application=self.application, function='dest_warehouse')
+        start = time()
+        try:
+            with transaction.atomic():
+                for msg in batch:
+                    (code, message) = proc.process(msg.ts, msg.doctype, msg.resourceid, msg.text)
+        except Exception as e:
+            # Isolate the failing message by writing the batch one transaction per message;
+            #   exceptions here propagate so that unacknowledged messages are redelivered
+            self.logger.error('Warehouse batch of {} failed ({}: {}), retrying one message at a time'.format( \
+                              len(batch), type(e).__name__, e))
+            metrics.inc('route_errors_total', stage='warehouse_batch')
+            from django.db import InterfaceError, OperationalError
+            for msg in batch:
+                try:
+                    with transaction.atomic():
+                        (code, message) = proc.process(msg.ts, msg.doctype, msg.resourceid, msg.text)
+                except Exception as e:
+                    if not drop_failed or isinstance(e, (InterfaceError, OperationalError)):
+                        raise
+                    self.logger.error('Warehouse exchange={} routing_key={} failed ({}: {}), dropped'.format( \
+                                      msg.doctype, msg.resourceid, type(e).__name__, e))
+                    metrics.inc('route_dropped_total', reason='warehouse')
+        metrics.observe('route_destination_seconds', time() - start, destination='warehouse')
+        for msg in batch:
+            report_lag(msg, 'warehouse')
+        self.logger.debug('Warehouse committed batch of {}'.format(len(batch)))
+
+class DedupCache():
+    # Bounded LRU cache of TestResult content hashes per doctype/resource/test, used to skip unchanged results
+    #   A result is forwarded when its content, ignoring keys that match the volatile pattern, differs from
+    #   the last one forwarded for its key, or when that was refresh seconds or more ago
+    def __init__(self, refresh, max_entries=100000, volatile=r'(Time|Timestamp|Date)$'):
+        self.refresh = refresh
+        self.max_entries = max_entries
+        self.volatile = re.compile(volatile)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = collections.OrderedDict()    # key -> (digest, forwarded time), least recent first
+
+    def stable(self, value):
+        if isinstance(value, dict):
+            return {k: self.stable(v) for (k, v) in value.items() if not self.volatile.search(k)}
+        if isinstance(value, list):
+            return [self.stable(v) for v in value]
+        return value
+
+    def forward(self, msg):
+        # True if the message should be forwarded, False if it repeats the cached result
+        test_result = msg.test_result()
+        if test_result is None:
+            return True
+        key = (msg.doctype, msg.resourceid, test_result.get('Name'))
+        digest = hashlib.blake2b(json.dumps(self.stable(test_result), sort_keys=True, separators=(',', ':')).encode(), \
+                                 digest_size=16).digest()
+        now = time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == digest and now - entry[1] < self.refresh:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('route_dedup_total', result='hit')
+                return False
+            self.entries[key] = (digest, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.misses += 1
+        metrics.inc('route_dedup_total', result='miss')
+        return True
+
+def topic_regex(pattern):
+    # Compile an AMQP topic binding pattern, where * matches one word and # zero or more words
+    words = pattern.split('.')
+    # Repeated # words match no more than one does
+    words = [word for (idx, word) in enumerate(words) if not (word == '#' and idx > 0 and words[idx-1] == '#')]
+    regex = ''
+    for (idx, word) in enumerate(words):
+        last = idx == len(words) - 1
+        if word == '#':
+            if idx == 0:
+                regex += '.*' if last else r'(?:.*\.)?'
+            else:
+                regex += r'(?:\..*)?' if last else r'\.(?:.*\.)?'
+            continue
+        if idx > 0 and words[idx-1] != '#':
+            regex += r'\.'
+        regex += r'[^.]+' if word == '*' else re.escape(word)
+    return re.compile(regex)
+
+class RoutingRules():
+    # Ordered include/exclude rules on exchange, routing key, resource and message size; the first match decides
+    #   A rule is {"ACTION": "include"|"exclude", "EXCHANGE": name(s), "ROUTING_KEY": AMQP topic pattern(s),
+    #   "RESOURCE": exact resource id(s), "MIN_BYTES": n, "MAX_BYTES": n}, where every condition given must match.
+    #   Decisions that don't depend on size are remembered per exchange and routing key.
+    def __init__(self, rules, default='include'):
+        if default not in ['include', 'exclude']:
+            raise ValueError('ROUTING_DEFAULT not {include, exclude}')
+        self.default = default
+        self.rules = []
+        for item in rules:
+            if item.get('ACTION') not in ['include', 'exclude']:
+                raise ValueError('ROUTING_RULES ACTION not {include, exclude}: ' + json.dumps(item))
+            unknown = set(item) - set(['ACTION', 'EXCHANGE', 'ROUTING_KEY', 'RESOURCE', 'MIN_BYTES', 'MAX_BYTES'])
+            if unknown:
+                raise ValueError('ROUTING_RULES unknown {}: {}'.format(', '.join(sorted(unknown)), json.dumps(item)))
+            self.rules.append({
+                'include': item['ACTION'] == 'include',
+                'exchanges': self.listed(item.get('EXCHANGE')),
+                'keys': [(key, topic_regex(key)) for key in self.listed(item.get('ROUTING_KEY')) or []] or None,
+                'resources': self.listed(item.get('RESOURCE')),
+                'min_bytes': item.get('MIN_BYTES'),
+                'max_bytes': item.get('MAX_BYTES'),
+            })
+        self.table = {}     # (exchange, routing_key) -> accepted, or None if it depends on size
+
+    def listed(self, value):
+        if value is None:
+            return None
+        return [value] if isinstance(value, str) else list(value)
+
+    def accept(self, exchange, routing_key, size):
+        key = (exchange, routing_key)
+        try:
+            accepted = self.table[key]
+        except KeyError:
+            accepted = self.decide(exchange, routing_key, None)
+            if len(self.table) >= 100000:
+                self.table.clear()
+            self.table[key] = accepted
+        if accepted is None:
+            accepted = self.decide(exchange, routing_key, size)
+        return accepted
+
+    def decide(self, exchange, routing_key, size):
+        # With size None, returns None if the decision depends on the size
+        for rule in self.rules:
+            if rule['exchanges'] is not None and exchange not in rule['exchanges']:
+                continue
+            if rule['resources'] is not None and routing_key not in rule['resources']:
+                continue
+            if rule['keys'] is not None and not any(regex.fullmatch(routing_key or '') for (key, regex) in rule['keys']):
+                continue
+            if rule['min_bytes'] is not None or rule['max_bytes'] is not None:
+                if size is None:
+                    return None
+                if (rule['min_bytes'] is not None and size < rule['min_bytes']) or \
+                   (rule['max_bytes'] is not None and size > rule['max_bytes']):
+                    continue
+            return rule['include']
+        return self.default == 'include'
+
+    def bindings(self, exchanges):
+        # The (exchange, binding key) pairs receiving every message the rules could include
+        #   An exchange gets the keys of its include rules up to an include or exclude rule for all its
+        #   routing keys, and '#' for the default include when no such rule is reached
+        pairs = []
+        for exchange in exchanges:
+            keys = []
+            for rule in self.rules:
+                if rule['exchanges'] is not None and exchange not in rule['exchanges']:
+                    continue
+                if rule['resources'] is not None:
+                    rule_keys = rule['resources']
+                elif rule['keys'] is not None:
+                    rule_keys = [key for (key, regex) in rule['keys']]
+                else:
+                    rule_keys = ['#']
+                if rule['include']:
+                    keys.extend(key for key in rule_keys if key not in keys)
+                    if '#' in rule_keys:
+                        break
+                elif rule_keys == ['#'] and rule['min_bytes'] is None and rule['max_bytes'] is None:
+                    break   # Nothing after this rule is included
+            else:
+                if self.default == 'include':
+                    keys.append('#')
+            if '#' in keys:
+                keys = ['#']
+            pairs.extend((exchange, key) for key in keys)
+        return pairs
+
+class AmqpFailback(Exception):
+    # Raised from housekeeping to leave the fallback broker once the primary answers again
+    pass
+
+class Backoff():
+    # Bounded exponential backoff with jitter: the first retry is immediate, later ones wait a random
+    #   half to whole of base * 2^n seconds, up to maximum, so consumers do not reconnect in lockstep
+    def __init__(self, base=1, maximum=60):
+        self.base = base
+        self.maximum = maximum
+        self.reset()
+
+    def reset(self):
+        self.attempt = 0
+
+    def next(self):
+        if self.attempt == 0:
+            delay = 0
+        else:
+            delay = min(self.maximum, self.base * 2 ** (self.attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+        self.attempt += 1
+        return delay
+
+class DeliveryTracker():
+    # Orders AMQP acknowledgements for messages that complete out of order
+    #   A delivery tag is acknowledged only once it and every earlier tag on the channel are done.
+    #   receive() returns a (generation, tag) token; complete() ignores tokens from a previous channel.
+    #   expect() adds completions a tag needs, one per additional destination it was sent to.
+    #   ackable_singly() releases done tags out of order, for when earlier tags are held back on purpose.
+    #   on_done() is called whenever a tag becomes done, from whichever thread completed it.
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        # A new channel restarts delivery tags at 1
+        with self.lock:
+            self.generation += 1
+            self.received = collections.deque()
+            self.done = set()
+            self.remaining = {}     # tag -> completions still needed, when more than one
+
+    def receive(self, tag):
+        with self.lock:
+            self.received.append(tag)
+            return (self.generation, tag)
+
+    def expect(self, token, count):
+        (generation, tag) = token
+        with self.lock:
+            if generation == self.generation:
+                self.remaining[tag] = self.remaining.get(tag, 1) + count
+
+    def complete(self, token):
+        (generation, tag) = token
+        with self.lock:
+            if generation != self.generation:
+                return
+            if tag in self.remaining:
+                self.remaining[tag] -= 1
+                if self.remaining[tag] > 0:
+                    return
+                del self.remaining[tag]
+            self.done.add(tag)
+        if self.on_done:
+            self.on_done()
+
+    def ackable(self):
+        # The highest tag that can be acknowledged with multiple=True, or None
+        last = None
+        with self.lock:
+            while self.received and self.received[0] in self.done:
+                last = self.received.popleft()
+                self.done.discard(last)
+        return last
+
+    def ackable_singly(self):
+        # Done tags waiting behind an unfinished one, to acknowledge individually with multiple=False
+        with self.lock:
+            if not self.done:
+                return []
+            tags = sorted(self.done)
+            self.received = collections.deque(tag for tag in self.received if tag not in self.done)
+            self.done = set()
+        return tags
+
+    def outstanding(self):
+        return len(self.received)
+
+class Coalescer():
+    # Holds the newest message per key for up to window seconds so superseded results are never written
+    #   A key keeps the deadline of its first held message, so a key updated continuously is still
+    #   released once per window.
+    def __init__(self, window):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.held = collections.OrderedDict()   # key -> (deadline, item), in deadline order
+
+    def add(self, key, msg):
+        # Returns the message this one supersedes, or None
+        previous = self.held.get(key)
+        if previous:
+            # Assigning to an existing key keeps its position, and so the deadline order
+            self.held[key] = (previous[0], msg)
+            return previous[1]
+        self.held[key] = (time() + self.window, msg)
+        return None
+
+    def expired(self):
+        now = time()
+        msgs = []
+        while self.held:
+            key = next(iter(self.held))
+            if self.held[key][0] > now:
+                break
+            msgs.append(self.held.pop(key)[1])
+        return msgs
+
+    def seconds_until_due(self):
+        if not self.held:
+            return self.window
+        return max(0, self.held[next(iter(self.held))][0] - time())
+
+class Spool():
+    # Durable append-only log of messages waiting for a destination, kept in numbered segment files
+    #   A record is a header with the metadata and body lengths, JSON metadata, and the body.
+    #   Appends are fsync'ed in batches and on_durable(tokens) is called once they are on disk.
+    #   One drainer reads durable records in order and commits its position to the 'cursor' file;
+    #   fully drained segments are deleted.
+    RECORD = struct.Struct('>II')
+
+    def __init__(self, path, on_durable, max_bytes=1<<30, segment_bytes=64<<20, fsync_count=100, fsync_seconds=0.2):
+        self.path = path
+        self.on_durable = on_durable
+        self.max_bytes = max_bytes
+        # The segment being written is never deleted, so keep it well under max_bytes, or a drained spool
+        #   could still count as full
+        self.segment_bytes = max(1, min(segment_bytes, max_bytes // 4))
+        self.fsync_count = fsync_count
+        self.fsync_seconds = fsync_seconds
+        self.logger = logging.getLogger('DaemonLog')
+        self.lock = threading.Condition()
+        os.makedirs(path, exist_ok=True)
+        segments = sorted(int(name[:-6]) for name in os.listdir(path) if name.endswith('.spool'))
+        self.bytes = sum(os.path.getsize(self.segment_path(seq)) for seq in segments)
+        # Always start a new segment, a previous run may have left a partial record at the end of the last one
+        self.write_seq = (segments[-1] + 1) if segments else 1
+        (self.read_seq, self.read_offset) = self.load_cursor(segments)
+        self.read_file = None
+        self.open_segment()
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, '{:010d}.spool'.format(seq))
+
+    def load_cursor(self, segments):
+        if not segments:
+            return (self.write_seq, 0)
+        try:
+            with open(os.path.join(self.path, 'cursor'), 'r') as file:
+                (seq, offset) = [int(field) for field in file.read().split()]
+        except (IOError, ValueError):
+            return (segments[0], 0)
+        if seq < segments[0]:
+            return (segments[0], 0)
+        if seq > segments[-1]:
+            return (self.write_seq, 0)
+        return (seq, offset)
+
+    def open_segment(self):
+        self.write_file = open(self.segment_path(self.write_seq), 'ab')
+        self.write_offset = self.synced_offset = 0
+        self.unsynced = []
+        self.unsynced_count = 0
+        self.last_sync = time()
+
+    def full(self):
+        return self.bytes >= self.max_bytes
+
+    def wait_for_space(self, timeout):
+        with self.lock:
+            if self.full():
+                self.lock.wait(timeout)
+
+    def append(self, msg):
+        is_str = not isinstance(msg.body, bytes)
+        body = msg.body.encode('utf-8') if is_str else msg.body
+        meta = json.dumps({'ts': msg.ts, 'doctype': msg.doctype, 'resourceid': msg.resourceid, 'str': is_str}).encode()
+        record = self.RECORD.pack(len(meta), len(body)) + meta + body
+        with self.lock:
+            self.write_file.write(record)
+            self.write_offset += len(record)
+            self.bytes += len(record)
+            if msg.token is not None:
+                self.unsynced.append(msg.token)
+            self.unsynced_count += 1
+            if self.unsynced_count < self.fsync_count and self.write_offset < self.segment_bytes:
+                return
+            tokens = self._sync()
+            if self.write_offset >= self.segment_bytes:
+                self.write_file.close()
+                self.write_seq += 1
+                self.open_segment()
+        self.on_durable(tokens)
+
+    def sync_due(self):
+        return self.unsynced_count and time() - self.last_sync >= self.fsync_seconds
+
+    def sync(self):
+        with self.lock:
+            tokens = self._sync()
+        self.on_durable(tokens)
+
+    def _sync(self):
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        tokens = self.unsynced
+        self.synced_offset = self.write_offset
+        self.unsynced = []
+        self.unsynced_count = 0
+        self.last_sync = time()
+        self.lock.notify_all()
+        return tokens
+
+    def position(self):
+        return (self.read_seq, self.read_offset)
+
+    def read(self, max_count=1, timeout=1):
+        # Returns up to max_count durable messages after the committed position, and the position after them
+        with self.lock:
+            if self.read_seq == self.write_seq and self.read_offset >= self.synced_offset:
+                self.lock.wait(timeout)
+            (write_seq, synced_offset) = (self.write_seq, self.synced_offset)
+        (seq, offset) = (self.read_seq, self.read_offset)
+        msgs = []
+        while len(msgs) < max_count and seq <= write_seq:
+            record = self.read_record(seq, offset, synced_offset if seq == write_seq else None)
+            if record:
+                msgs.append(record[0])
+                offset += record[1]
+            elif seq < write_seq:
+                (seq, offset) = (seq + 1, 0)
+            else:
+                break
+        return (msgs, (seq, offset))
+
+    def read_record(self, seq, offset, limit):
+        if limit is not None and offset >= limit:
+            return None
+        if not self.read_file or self.read_file.name != self.segment_path(seq):
+            if self.read_file:
+                self.read_file.close()
+            self.read_file = open(self.segment_path(seq), 'rb')
+        self.read_file.seek(offset)
+        header = self.read_file.read(self.RECORD.size)
+        if not header:
+            return None
+        if len(header) == self.RECORD.size:
+            (meta_len, body_len) = self.RECORD.unpack(header)
+            data = self.read_file.read(meta_len + body_len)
+            if len(data) == meta_len + body_len:
+                meta = json.loads(data[:meta_len])
+                body = data[meta_len:]
+                if meta['str']:
+                    body = body.decode('utf-8')
+                return (Message(meta['ts'], meta['doctype'], meta['resourceid'], body), self.RECORD.size + len(data))
+        self.logger.warning('Spool segment {} has a partial record at offset {}, skipping the rest'.format( \
+                            self.segment_path(seq), offset))
+        return None
+
+    def commit(self, position):
+        with self.lock:
+            for seq in range(self.read_seq, position[0]):
+                path = self.segment_path(seq)
+                if os.path.exists(path):
+                    self.bytes -= os.path.getsize(path)
+                    os.remove(path)
+            (self.read_seq, self.read_offset) = position
+            cursor = os.path.join(self.path, 'cursor')
+            with open(cursor + '.new', 'w') as file:
+                file.write('{} {}\n'.format(*position))
+            os.replace(cursor + '.new', cursor)
+            self.lock.notify_all()
+
+class SpoolDrainer(threading.Thread):
+    # Sends spooled messages to a destination, backing off exponentially while it is failing
+    #   send(msgs) must raise if any message could not be delivered
+    def __init__(self, spool, send, name, batch=1, backoff_max=300):
+        super().__init__(name='spool-' + name, daemon=True)
+        self.spool = spool
+        self.send = send
+        self.batch = batch
+        self.backoff_max = backoff_max
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger('DaemonLog')
+
+    def run(self):
+        backoff = 0
+        while not self.stopping.is_set():
+            (msgs, position) = self.spool.read(self.batch, timeout=1)
+            if msgs:
+                try:
+                    self.send(msgs)
+                except Exception as e:
+                    metrics.inc('route_retries_total', destination=self.name)
+                    backoff = min(max(1, 2 * backoff), self.backoff_max)
+                    self.logger.error('Spool {} send failed ({}: {}); retrying in {}/seconds'.format( \
+                                      self.name, type(e).__name__, e, backoff))
+                    self.stopping.wait(backoff)
+                    continue
+                backoff = 0
+            if position != self.spool.position():
+                self.spool.commit(position)
+
+    def stop(self):
+        self.stopping.set()
+
+class Sink(threading.Thread):
+    # A fan-out destination with its own bounded buffer and delivery thread, so a slow sink doesn't hold up the others
+    #   A required sink's messages are acknowledged only once it has them, and put() blocks while its buffer is
+    #   full; an optional sink drops messages instead. on_error(e) is called when a required sink fails.
+    #   A sink with a spool appends to it instead, and its SpoolDrainer delivers; a required sink's messages
+    #   are then acknowledged once they are on disk.
+    def __init__(self, destination, deliver, housekeeping=None, on_error=None, required=True, size=1000):
+        super().__init__(name='sink-' + destination, daemon=True)
+        self.destination = destination
+        self.deliver = deliver
+        self.housekeeping = housekeeping
+        self.on_error = on_error
+        self.required = required
+        self.buffer = queue.Queue(maxsize=size)
+        self.spool = None
+        self.logger = logging.getLogger('DaemonLog')
+
+    def put(self, msg):
+        if self.spool:
+            if self.required:
+                self.spool.append(msg)
+            elif self.spool.full():
+                metrics.inc('route_dropped_total', reason='sink_full_' + self.destination)
+            else:
+                self.spool.append(msg.copy())
+            return
+        if self.required:
+            self.buffer.put(msg)
+            return
+        try:
+            self.buffer.put_nowait(msg.copy())
+        except queue.Full:
+            metrics.inc('route_dropped_total', reason='sink_full_' + self.destination)
+
+    def clear(self):
+        # Discard buffered messages, which will be redelivered on a new channel
+        try:
+            while True:
+                self.buffer.get_nowait()
+        except queue.Empty:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                msg = self.buffer.get(timeout=1)
+            except queue.Empty:
+                msg = None
+            try:
+                if msg is not None:
+                    self.deliver(msg)
+                if self.housekeeping:
+                    self.housekeeping()
+            except Exception as e:
+                metrics.inc('route_errors_total', stage='sink_' + self.destination)
+                self.logger.error('Sink {} {}: {}'.format(self.destination, type(e).__name__, e))
+                if self.required and self.on_error:
+                    self.on_error(e)
+            metrics.set('route_sink_buffered', self.buffer.qsize(), destination=self.destination)
+
+ARCHIVE_SUFFIX = '.jsonl.gz'
+ARCHIVE_INDEX_SUFFIX = '.idx.json'
+ARCHIVE_OPEN_SUFFIX = '.part'
+
+class ArchiveWriter():
+    # Appends messages to rotating, gzip'ed JSON-lines segment files, one open segment per exchange
+    #   A segment is written as <exchange>/<ts>_<n>.jsonl.gz.part and, once it reaches max_bytes of
+    #   messages or is max_seconds old, renamed to .jsonl.gz next to a small .idx.json index with its
+    #   record count, time range, and per routing key counts. Each line is a JSON object with ts,
+    #   exchange, routing_key and body. A tag, <ts>_<tag><n>, keeps concurrent writers' segments apart.
+    def __init__(self, top, max_bytes=64<<20, max_seconds=3600, tag=''):
+        self.top = top
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.tag = tag
+        self.segments = {}      # exchange -> open segment state
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('DaemonLog')
+        self.recover()
+
+    def recover(self):
+        # Finish segments a previous run with this writer's tag left open
+        for entry in os.scandir(self.top):
+            if not entry.is_dir():
+                continue
+            for name in os.listdir(entry.path):
+                if name.endswith(ARCHIVE_SUFFIX + ARCHIVE_OPEN_SUFFIX) and name.partition('_')[2].startswith(self.tag):
+                    path = os.path.join(entry.path, name)
+                    segment = self.new_state(path)
+                    for record in read_archive(path):
+                        self.count(segment, record['ts'], record['routing_key'], 0)
+                    segment['bytes'] = os.path.getsize(path)
+                    self.finish(segment)
+                    self.logger.warning('Recovered archive segment {} with {} records'.format( \
+                                        segment['final'], segment['records']))
+
+    def new_state(self, path):
+        return {'path': path, 'final': path[:-len(ARCHIVE_OPEN_SUFFIX)], 'file': None, 'opened': time(), \
+                'bytes': 0, 'records': 0, 'first_ts': None, 'last_ts': None, 'routing_keys': {}}
+
+    def count(self, segment, ts, routing_key, nbytes):
+        segment['bytes'] += nbytes
+        segment['records'] += 1
+        segment['first_ts'] = segment['first_ts'] or ts
+        segment['last_ts'] = ts
+        segment['routing_keys'][routing_key] = segment['routing_keys'].get(routing_key, 0) + 1
+
+    def open(self, exchange, ts):
+        while True:
+            self.counter += 1
+            name = '{}_{}{}{}'.format(ts, self.tag, self.counter, ARCHIVE_SUFFIX)
+            final = os.path.join(self.top, exchange, name)
+            if not os.path.exists(final) and not os.path.exists(final + ARCHIVE_OPEN_SUFFIX):
+                break
+        segment = self.new_state(final + ARCHIVE_OPEN_SUFFIX)
+        segment['file'] = gzip.open(segment['path'], 'at', encoding='utf-8')
+        self.segments[exchange] = segment
+        return segment
+
+    def finish(self, segment):
+        if segment['file']:
+            segment['file'].close()
+        os.replace(segment['path'], segment['final'])
+        index = {key: segment[key] for key in ['records', 'bytes', 'first_ts', 'last_ts', 'routing_keys']}
+        with open(segment['final'][:-len(ARCHIVE_SUFFIX)] + ARCHIVE_INDEX_SUFFIX, 'w') as file:
+            json.dump(index, file)
+
+    def write(self, msg):
+        body = msg.text
+        line = json.dumps({'ts': msg.ts, 'exchange': msg.doctype, 'routing_key': msg.resourceid, 'body': body}) + '\n'
+        with self.lock:
+            segment = self.segments.get(msg.doctype)
+            if segment and (segment['bytes'] >= self.max_bytes or time() - segment['opened'] >= self.max_seconds):
+                self.finish(self.segments.pop(msg.doctype))
+                segment = None
+            if not segment:
+                segment = self.open(msg.doctype, msg.ts)
+            segment['file'].write(line)
+            # A sync flush keeps every acknowledged message readable even if the segment is never closed
+            segment['file'].flush()
+            self.count(segment, msg.ts, msg.resourceid, len(line))
+            return os.path.basename(segment['final'])
+
+    def rotate_due(self):
+        # Finish segments past max_seconds even when their exchange has stopped receiving messages
+        with self.lock:
+            for (exchange, segment) in list(self.segments.items()):
+                if time() - segment['opened'] >= self.max_seconds:
+                    self.finish(self.segments.pop(exchange))
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                self.finish(segment)
+            self.segments = {}
+
+def read_archive(path):
+    # Yield the records of an archive segment, stopping quietly at a truncated end
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    break
+                yield json.loads(line)
+    except (EOFError, zlib.error, OSError, ValueError) as e:
+        logging.getLogger('DaemonLog').warning('Archive segment {} ends early: {}'.format(path, e))
+
+class ExpireThread(threading.Thread):
+    # Deletes expired monitoring records on its own timer, off the message handling path
+    #   The next pass starts interval seconds after the previous one finished.
+    def __init__(self, interval=3600):
+        super().__init__(name='expire', daemon=True)
+        self.interval = interval
+        self.expirer = Glue2DeleteExpiredMonitoring(interval = interval)
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger('DaemonLog')
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.expire()
+            self.stopping.wait(self.interval)
+
+    def expire(self):
+        start = datetime.utcnow()
+        try:
+            (code, message) = self.expirer.delete()
+        except Exception as e:
+            (code, message) = (False, '{}: {}'.format(type(e).__name__, e))
+        finally:
+            # Don't hold an idle database connection between passes
+            db_connection.close()
+        seconds = (datetime.utcnow() - start).total_seconds()
+        metrics.observe('route_expire_seconds', seconds)
+        if not code:
+            metrics.inc('route_errors_total', stage='expire')
+            self.logger.error('Expirer reported: {} ({:.3f}/seconds)'.format(message, seconds))
+        else:
+            self.logger.info('Expirer reported: {} ({:.3f}/seconds)'.format(message or 'nothing expired', seconds))
+
+    def stop(self):
+        self.stopping.set()
+
+def scan_files(top):
+    # Lazily yield (path, size) for every file under top at any depth, without following symlinked directories
+    stack = [top]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield (entry.path, entry.stat().st_size)
+        except OSError as e:
+            logging.getLogger('DaemonLog').error('Scanning directory: {}'.format(e))
+
+class ReplayCheckpoint():
+    # Append-only record of replayed files so an interrupted replay can resume where it stopped
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.done = set(line.rstrip('\n') for line in file)
+        self.file = open(path, 'a') if path else None
+
+    def __contains__(self, path):
+        return path in self.done
+
+    def add(self, paths):
+        if self.file:
+            self.file.write(''.join(path + '\n' for path in paths))
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class ReplayProgress():
+    # Periodically log replay files/s and bytes/s
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.start = self.last_report = time()
+        self.files = self.bytes = self.skipped = self.failed = 0
+        self.logger = logging.getLogger('DaemonLog')
+
+    def add(self, files, nbytes):
+        self.files += files
+        self.bytes += nbytes
+        if time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self, final=False):
+        self.last_report = time()
+        elapsed = max(self.last_report - self.start, 0.001)
+        self.logger.info('Replay {} files={} bytes={} skipped={} failed={} in {:.1f}/seconds, {:.1f} files/s, {:.0f} bytes/s'.format( \
+                         'done' if final else 'progress', self.files, self.bytes, self.skipped, self.failed, \
+                         elapsed, self.files / elapsed, self.bytes / elapsed))
+
+class DirectoryWatcher():
+    # Follows a directory tree for files that are completely written, with inotify where the C library has
+    #   it and by polling otherwise. A file is ready once its writer closes it or it is moved in (inotify),
+    #   or once its size and mtime have not changed for settle seconds (files found by scanning). A file is
+    #   offered once and again only if it is rewritten, and never while its path is in done.
+    IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+    IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x800, 0x4000, 0x8000, 0x40000000
+    IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, os.O_CLOEXEC
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MOVE_SELF
+
+    def __init__(self, top, done, ignore=None, poll=2, settle=5):
+        self.top = top
+        self.done = done
+        self.ignore = ignore or (lambda name: name.startswith('.'))
+        self.poll = poll
+        self.settle = settle
+        self.candidates = {}    # path -> True when known to be complete, False to wait for it to settle
+        self.seen = {}          # path -> ((size, mtime), first seen) of candidates waiting to settle
+        self.offered = {}       # path -> (size, mtime) when returned by ready()
+        self.dirs = {}          # directory -> (mtime, subdirectories) when last listed, for polling
+        self.wds = {}           # inotify watch descriptor -> directory
+        self.watched = set()    # directories with an inotify watch
+        self.next_poll = 0
+        self.rescan = True
+        self.logger = logging.getLogger('DaemonLog')
+        self.fd = None
+        try:
+            import ctypes
+            import ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.get_errno = ctypes.get_errno
+            self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(self.get_errno(), os.strerror(self.get_errno()))
+        except (OSError, AttributeError) as e:
+            self.logger.warning('Watch without inotify, polling every {}/seconds: {}'.format(poll, e))
+            self.fd = None
+        self.method = 'inotify' if self.fd is not None else 'polling'
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def ready(self, timeout):
+        # Wait up to timeout seconds for activity and return [(path, size, mtime)] of files ready to process
+        if self.fd is not None:
+            if self.rescan:
+                self.rescan = False
+                self.scan(self.top)
+            else:
+                self.inotify_read(min(timeout, self.settle) if self.candidates else timeout)
+        else:
+            wait = self.next_poll - time()
+            if wait > 0:
+                sleep(min(wait, timeout))
+            if time() >= self.next_poll:
+                self.next_poll = time() + self.poll
+                self.scan(self.top, changed_only=not self.rescan)
+                self.rescan = False
+        return self.settled()
+
+    def completed(self, path, remember=True):
+        # Done with path; remember it so it is never offered again, or forget it because it was moved away
+        self.offered.pop(path, None)
+        if remember:
+            self.done.add(path)
+
+    def observe(self, path, complete=False):
+        if self.ignore(os.path.basename(path)) or path in self.done:
+            return
+        self.candidates[path] = complete or self.candidates.get(path, False)
+
+    def scan(self, top, changed_only=False):
+        # Observe every file under top, watching each directory first so no file can slip in unnoticed
+        #   When polling, directories whose mtime has not changed hold no new files and are not listed
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+                if self.fd is not None:
+                    self.inotify_add(path)
+                elif changed_only and path in self.dirs and self.dirs[path][0] == mtime and time() - mtime > self.poll:
+                    stack.extend(self.dirs[path][1])
+                    continue
+                subdirs = []
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            self.observe(entry.path)
+                self.dirs[path] = (mtime, subdirs)
+                stack.extend(subdirs)
+            except OSError as e:
+                self.dirs.pop(path, None)
+                if path == top:
+                    self.logger.error('Scanning directory: {}'.format(e))
+
+    def settled(self):
+        now = time()
+        ready = []
+        for (path, complete) in list(self.candidates.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.candidates[path]
+                self.seen.pop(path, None)
+                self.offered.pop(path, None)
+                continue
+            key = (st.st_size, st.st_mtime)
+            if path in self.done or self.offered.get(path) == key:
+                del self.candidates[path]
+                self.seen.pop(path, None)
+                continue
+            if not complete:
+                if path not in self.seen or self.seen[path][0] != key:
+                    self.seen[path] = (key, now)
+                if now - self.seen[path][1] < self.settle or now - st.st_mtime < self.settle:
+                    continue
+            del self.candidates[path]
+            self.seen.pop(path, None)
+            self.offered[path] = key
+            ready.append((path, st.st_size, st.st_mtime))
+        return ready
+
+    def inotify_add(self, path):
+        if path in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            # Typically the fs.inotify.max_user_watches limit; polling needs no watches
+            self.logger.warning('Watch falling back to polling every {}/seconds, inotify_add_watch {}: {}'.format( \
+                                self.poll, path, os.strerror(self.get_errno())))
+            self.close()
+            self.method = 'polling'
+            self.rescan = True
+            return
+        self.wds[wd] = path
+        self.watched.add(path)
+
+    def inotify_read(self, timeout):
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset+16:offset+16+length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.rescan = True
+            elif mask & self.IN_MOVE_SELF:
+                # Watches below a moved directory report stale paths, so start over
+                for old in list(self.wds):
+                    self.libc.inotify_rm_watch(self.fd, old)
+                self.wds.clear()
+                self.watched.clear()
+                self.rescan = True
+            elif mask & self.IN_IGNORED:
+                self.watched.discard(self.wds.pop(wd, None))
+            elif wd in self.wds:
+                path = os.path.join(self.wds[wd], name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.scan(path)
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    self.observe(path, complete=True)
+        if self.rescan and self.fd is not None:
+            self.rescan = False
+            self.scan(self.top)
+
+# The router replaying in forked replay processes, see Router.replay_directory
+_replay_router = None
+
+def _replay_chunk(chunk):
+    return _replay_router.replay_chunk(chunk)
+
 class Router():
     def __init__(self):
+        self.started = time()
         # Parse arguments
         parser = argparse.ArgumentParser(epilog='File|Directory SRC|DEST syntax: {file|directory}:<file|directory path and name')
         parser.add_argument('daemonaction', nargs='?', choices=('start', 'stop', 'restart'), \
@@ -55,6 +1411,22 @@ class Router():
         # Don't set the default so that we can apply the precedence argument || config || default
         parser.add_argument('-q', '--queue', action='store', \
                             help='AMQP queue default=monitoring-router')
+        parser.add_argument('-w', '--workers', action='store', type=int, \
+                            help='AMQP message worker threads, 0 to process serially (default=0)')
+        parser.add_argument('-e', '--engine', action='store', choices=('threads', 'asyncio'), \
+                            help='AMQP source engine {threads, asyncio} (default=threads)')
+        parser.add_argument('--prefetch', action='store', type=int, \
+                            help='AMQP unacknowledged message prefetch count (default=4)')
+        parser.add_argument('-p', '--processes', action='store', type=int, \
+                            help='Directory source replay processes, 0 to replay serially (default=0)')
+        parser.add_argument('--checkpoint', action='store', \
+                            help='Directory source replay checkpoint file, to resume an interrupted replay')
+        parser.add_argument('--watch', action='store_true', \
+                            help='Directory source keeps following the directory for new files (default=WATCH config)')
+        parser.add_argument('--fanout', action='append', \
+                            help='Additional required destination, may be repeated (default=FANOUT config)')
+        parser.add_argument('--shards', action='store', type=int, \
+                            help='AMQP source consumer processes run by a supervisor, 0 for one process (default=0)')
         parser.add_argument('--expire', action='store_true', \
                             help='Delete expired monitoring records')
         parser.add_argument('--pdb', action='store_true', \
@@ -62,6 +1434,7 @@ class Router():
         self.args = parser.parse_args()
 
         if self.args.pdb:
+            import pdb
             pdb.set_trace()
 
         # Load configuration file
@@ -90,8 +1463,12 @@ class Router():
         loglevel_num = getattr(logging, loglevel_str, None)
         self.logger = logging.getLogger('DaemonLog')
         self.logger.setLevel(loglevel_num)
-        self.formatter = logging.Formatter(fmt='%(asctime)s.%(msecs)03d %(levelname)s %(message)s', \
-                                           datefmt='%Y/%m/%d %H:%M:%S')
+        self.msglog = logging.getLogger(MESSAGE_LOG)
+        if self.config.get('LOG_FORMAT', 'text') == 'json':
+            self.formatter = JsonLogFormatter()
+        else:
+            self.formatter = logging.Formatter(fmt='%(asctime)s.%(msecs)03d %(levelname)s %(message)s', \
+                                               datefmt='%Y/%m/%d %H:%M:%S')
         self.handler = logging.handlers.TimedRotatingFileHandler(self.config['LOG_FILE'], \
             when='W6', backupCount=999, utc=True)
         self.handler.setFormatter(self.formatter)
@@ -108,16 +1485,19 @@ class Router():
         signal.signal(signal.SIGINT, self.exit_signal)
         signal.signal(signal.SIGTERM, self.exit_signal)
 
+        self.engine = self.args.engine or self.config.get('ENGINE', 'threads')
+        if self.engine not in ['threads', 'asyncio']:
+            self.logger.error('Engine not {threads, asyncio}')
+            sys.exit(1)
+
         self.logger.info('Starting program=%s pid=%s, uid=%s(%s)' % \
                      (os.path.basename(__file__), os.getpid(), os.geteuid(), pwd.getpwuid(os.geteuid()).pw_name))
                      
         self.src = {}
         self.altsrc = {}
-        self.dest = {}
         for var in ['type', 'obj', 'host', 'port', 'display']:
             self.src[var] = None
             self.altsrc[var] = None
-            self.dest[var] = None
 
         # Verify arguments and parse compound arguments
         if 'src' not in self.args or not self.args.src: # Tests for None and empty ''
@@ -144,6 +1524,24 @@ class Router():
             if not self.src['port']:
                 self.src['port'] = '5671'
             self.src['display'] = '%s@%s:%s' % (self.src['type'], self.src['host'], self.src['port'])
+            alternate = self.config.get('AMQP_FALLBACK', None)
+            if alternate:
+                idx = alternate.find(':')
+                if idx > 0:
+                    (self.altsrc['type'], self.altsrc['obj']) = (alternate[0:idx], alternate[idx+1:])
+                else:
+                    self.altsrc['type'] = alternate
+                if self.altsrc['type'] != 'amqp' or not self.altsrc['obj']:
+                    self.logger.error('Alternate source not amqp:<host>[:<port>]')
+                    sys.exit(1)
+                idx = self.altsrc['obj'].find(':')
+                if idx > 0:
+                    (self.altsrc['host'], self.altsrc['port']) = (self.altsrc['obj'][0:idx], self.altsrc['obj'][idx+1:])
+                else:
+                    self.altsrc['host'] = self.altsrc['obj']
+                if not self.altsrc['port']:
+                    self.altsrc['port'] = '5671'
+                self.altsrc['display'] = '%s@%s:%s' % (self.altsrc['type'], self.altsrc['host'], self.altsrc['port'])
         elif self.src['obj']:
             self.src['display'] = '%s:%s' % (self.src['type'], self.src['obj'])
         else:
@@ -154,47 +1552,190 @@ class Router():
                 self.args.dest = self.config['DESTINATION']
         if 'dest' not in self.args or not self.args.dest:
             self.args.dest = 'print'
-        idx = self.args.dest.find(':')
+        self.dests = {}         # type -> destination, for the destination and every fan-out sink
+        self.dest = self.setup_destination(self.args.dest)
+
+        # Fan-out sinks, each a destination spec or {"DESTINATION": spec, "REQUIRED": bool, "BUFFER": count}
+        self.sinks = []
+        for item in self.config.get('FANOUT', []) + (self.args.fanout or []):
+            if not isinstance(item, dict):
+                item = {'DESTINATION': item}
+            dest = self.setup_destination(item['DESTINATION'])
+            required = bool(item.get('REQUIRED', True))
+            housekeeping = self.warehouse_sink_housekeeping if dest['type'] == 'warehouse' else None
+            self.sinks.append(Sink(dest['type'], lambda msg, type=dest['type']: self.deliver(type, msg), \
+                                   housekeeping=housekeeping, on_error=self.sink_error, required=required, \
+                                   size=int(item.get('BUFFER', 1000))))
+            self.logger.info('Fan-out: {}{}'.format(dest['display'], '' if required else ' (optional)'))
+
+        if self.args.expire:
+            load_warehouse()
+
+        # Messages over MAX_MESSAGE_BYTES go to QUARANTINE_DIR instead of the destinations, 0 for no limit
+        self.max_message_bytes = int(self.config.get('MAX_MESSAGE_BYTES', 0))
+
+        try:
+            self.rules = RoutingRules(self.config.get('ROUTING_RULES', []), \
+                                      default=self.config.get('ROUTING_DEFAULT', 'include'))
+        except (ValueError, re.error) as e:
+            self.logger.error('Routing rules: {}'.format(e))
+            sys.exit(1)
+
+        self.shard = None
+        self.shards = self.args.shards
+        if self.shards is None:
+            self.shards = int(self.config.get('SHARDS', 0))
+        if self.shards and self.src['type'] != 'amqp':
+            self.logger.warning('Ignoring SHARDS, only the amqp source is sharded')
+            self.shards = 0
+
+        # AMQP reconnection: both brokers are raced with a connect timeout and retried with jittered
+        #   backoff, and while on the fallback the primary is probed every AMQP_FAILBACK_SECONDS
+        self.amqp_connect_timeout = float(self.config.get('AMQP_CONNECT_TIMEOUT', 10))
+        self.amqp_primary_grace = float(self.config.get('AMQP_PRIMARY_GRACE', 2))
+        self.failback_seconds = float(self.config.get('AMQP_FAILBACK_SECONDS', 300))
+        self.amqp_backoff = Backoff(maximum=float(self.config.get('AMQP_BACKOFF_MAX', 60)))
+        self.amqp_primary = True
+        self.amqp_connected_at = None
+        self.amqp_disconnected_at = None
+        self.failback_conn = None
+        self.failback_probe = None
+        self.failback_at = 0
+
+        self.logger.info('Source: ' + self.src['display'])
+        if self.altsrc['display']:
+            self.logger.info('Fallback source: ' + self.altsrc['display'])
+        self.logger.info('Destination: ' + self.dest['display'])
+        self.logger.info('Config: ' + self.config_file)
+
+        # A supervisor forks its shards, and must not be running other threads when it does
+        if not self.shards:
+            self.logging_setup()
+            self.metrics_setup()
+
+        seconds = time() - self.started
+        metrics.observe('route_startup_seconds', seconds)
+        self.logger.info('Started in {:.3f}/seconds{}'.format(seconds, ', with Django' if django else ''))
+
+    def setup_destination(self, spec):
+        # Parse a destination spec and set up what its type needs
+        dest = {var: None for var in ['type', 'obj', 'host', 'port', 'display']}
+        idx = spec.find(':')
         if idx > 0:
-            (self.dest['type'], self.dest['obj']) = (self.args.dest[0:idx], self.args.dest[idx+1:])
+            (dest['type'], dest['obj']) = (spec[0:idx], spec[idx+1:])
         else:
-            self.dest['type'] = self.args.dest
-        if self.dest['type'] == 'dir':
-            self.dest['type'] = 'directory'
-        elif self.dest['type'] not in ['print', 'directory', 'warehouse', 'api']:
+            dest['type'] = spec
+        if dest['type'] == 'dir':
+            dest['type'] = 'directory'
+        elif dest['type'] not in ['print', 'directory', 'warehouse', 'api']:
             self.logger.error('Destination not {print, directory, warehouse, api}')
             sys.exit(1)
-        if self.dest['type'] == 'api':
-            idx = self.dest['obj'].find(':')
+        if dest['type'] in self.dests:
+            self.logger.error('Destination {} used more than once'.format(dest['type']))
+            sys.exit(1)
+        self.dests[dest['type']] = dest
+        if dest['type'] == 'api':
+            idx = dest['obj'].find(':')
             if idx > 0:
-                (self.dest['host'], self.dest['port']) = (self.dest['obj'][0:idx], self.dest['obj'][idx+1:])
+                (dest['host'], dest['port']) = (dest['obj'][0:idx], dest['obj'][idx+1:])
             else:
-                self.dest['host'] = self.dest['obj']
-            if not self.dest['port']:
-                self.dest['port'] = '443'
-            self.dest['display'] = '%s@%s:%s' % (self.dest['type'], self.dest['host'], self.dest['port'])
-        elif self.dest['type'] == 'warehouse':
-            self.dest['display'] = '{}@database={}'.format(self.dest['type'], settings.DATABASES['default']['HOST'])
-        elif self.dest['obj']:
-            self.dest['display'] = '%s:%s' % (self.dest['type'], self.dest['obj'])
+                dest['host'] = dest['obj']
+            if not dest['port']:
+                dest['port'] = '443'
+            dest['display'] = '%s@%s:%s' % (dest['type'], dest['host'], dest['port'])
+            pool_size = int(self.config.get('API_POOL_SIZE', 4))
+            if self.engine == 'asyncio':
+                pool_size = max(pool_size, int(self.config.get('API_INFLIGHT', 16)))
+            self.api_pool = ApiConnectionPool(dest['host'], dest['port'], self.config, \
+                                              size=pool_size, \
+                                              timeout=int(self.config.get('API_TIMEOUT', 60)))
+            # Bodies of at least API_GZIP_BYTES are sent with Content-Encoding: gzip, 0 to never compress
+            self.api_gzip_bytes = int(self.config.get('API_GZIP_BYTES', 0))
+            self.api_gzip_level = int(self.config.get('API_GZIP_LEVEL', 6))
+        elif dest['type'] == 'warehouse':
+            load_warehouse()
+            dest['display'] = '{}@database={}'.format(dest['type'], settings.DATABASES['default']['HOST'])
+            self.warehouse_batcher = WarehouseBatcher(os.path.basename(__file__), self.warehouse_committed, \
+                                                      max_count=int(self.config.get('WAREHOUSE_BATCH_SIZE', 50)), \
+                                                      max_seconds=float(self.config.get('WAREHOUSE_BATCH_SECONDS', 2)))
+        elif dest['obj']:
+            dest['display'] = '%s:%s' % (dest['type'], dest['obj'])
         else:
-            self.dest['display'] = self.dest['type']
+            dest['display'] = dest['type']
 
-        if self.src['type'] in ['file', 'directory'] and self.dest['type'] == 'directory':
+        if self.src['type'] in ['file', 'directory'] and dest['type'] == 'directory':
             self.logger.error('Source {file, directory} can not be routed to Destination {directory}')
             sys.exit(1)
 
-        if self.dest['type'] == 'directory':
-            if not self.dest['obj']:
-                self.dest['obj'] = os.getcwd()
-            self.dest['obj'] = os.path.abspath(self.dest['obj'])
-            if not os.access(self.dest['obj'], os.W_OK):
-                self.logger.error('Destination directory=%s not writable' % self.dest['obj'])
+        if dest['type'] == 'directory':
+            if not dest['obj']:
+                dest['obj'] = os.getcwd()
+            dest['obj'] = os.path.abspath(dest['obj'])
+            if not os.access(dest['obj'], os.W_OK):
+                self.logger.error('Destination directory=%s not writable' % dest['obj'])
+                sys.exit(1)
+            self.writable_dirs = set()
+            self.archive = None
+            archive_format = self.config.get('ARCHIVE_FORMAT', 'files')
+            if archive_format == 'segments':
+                self.archive = ArchiveWriter(dest['obj'], \
+                                             max_bytes=int(self.config.get('ARCHIVE_SEGMENT_BYTES', 64<<20)), \
+                                             max_seconds=int(self.config.get('ARCHIVE_SEGMENT_SECONDS', 3600)))
+                # Open segments are only replayable once finished, including on exit and SIGTERM (via sys.exit)
+                atexit.register(self.archive_close)
+            elif archive_format != 'files':
+                self.logger.error('ARCHIVE_FORMAT not {files, segments}')
                 sys.exit(1)
+        return dest
 
-        self.logger.info('Source: ' + self.src['display'])
-        self.logger.info('Destination: ' + self.dest['display'])
-        self.logger.info('Config: ' + self.config_file)
+    def logging_setup(self):
+        # Sample per-message log lines and, unless LOG_ASYNC is false, format and write records on a background thread
+        if self.config.get('LOG_FORMAT', 'text') not in ['text', 'json']:
+            self.logger.error('LOG_FORMAT not {text, json}')
+            sys.exit(1)
+        self.log_sampler = LogSampler(rate=float(self.config.get('LOG_SAMPLE_RATE', 1)), \
+                                      limit=int(self.config.get('LOG_RATE_LIMIT', 0)))
+        self.log_listener = None
+        if not self.config.get('LOG_ASYNC', True):
+            self.handler.addFilter(self.log_sampler)
+            return
+        log_queue = queue.Queue()
+        self.log_queue_handler = LogQueueHandler(log_queue)
+        self.log_queue_handler.addFilter(self.log_sampler)
+        self.log_listener = logging.handlers.QueueListener(log_queue, self.handler, respect_handler_level=True)
+        self.log_listener.start()
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(self.log_queue_handler)
+        atexit.register(self.logging_stop)
+
+    def logging_synchronous(self):
+        # Before forking: a child inherits the queue but not the listener thread draining it, so write directly
+        if getattr(self, 'log_listener', None):
+            self.logging_stop()
+            self.logger.removeHandler(self.log_queue_handler)
+            self.handler.addFilter(self.log_sampler)
+            self.logger.addHandler(self.handler)
+
+    def logging_stop(self):
+        # Write out queued records
+        if getattr(self, 'log_listener', None):
+            (listener, self.log_listener) = (self.log_listener, None)
+            listener.stop()
+
+    def metrics_setup(self, suffix='', port_offset=0):
+        # Only the amqp consumer serves metrics, so file and directory runs sharing its config don't collide
+        if self.config.get('METRICS_PORT') and self.src['type'] == 'amqp':
+            bind = (self.config.get('METRICS_BIND', '127.0.0.1'), int(self.config['METRICS_PORT']) + port_offset)
+            try:
+                self.metrics_server = serve_metrics(bind)
+                self.logger.info('Metrics: http://{}:{}/metrics'.format(*bind))
+            except OSError as e:
+                self.logger.error('Metrics endpoint {}:{} not started: {}'.format(bind[0], bind[1], e))
+        if self.config.get('METRICS_FILE_SECONDS') and self.config.get('RUN_DIR'):
+            name = os.path.basename(__file__).replace('.py', '')
+            path = os.path.join(self.config['RUN_DIR'], '{}{}.metrics'.format(name, suffix))
+            MetricsFileThread(path, interval=int(self.config['METRICS_FILE_SECONDS'])).start()
+            self.logger.info('Metrics file: {}'.format(path))
 
     def SaveDaemonLog(self, path):
         # Save daemon log file using timestamp only if it has anything unexpected in it
@@ -211,6 +1752,13 @@ class Router():
             self.logger.error('Exception in SaveDaemonStdOut({})'.format(path))
         return
 
+    def archive_close(self):
+        if getattr(self, 'archive', None):
+            try:
+                self.archive.close()
+            except OSError as e:
+                self.logger.error('Closing archive segments: {}'.format(e))
+
     def exit_signal(self, signum, frame):
         self.logger.critical('Caught signal={}({}), exiting with rc={}'.format(signum, signal.Signals(signum).name, signum))
         sys.exit(signum)
@@ -220,287 +1768,777 @@ class Router():
             self.logger.error('Exiting with rc={}'.format(rc))
         sys.exit(rc)
 
-    def ConnectAmqp_UserPass(self):
+    def amqp_connect(self, host):
         ssl_opts = {'ca_certs': os.environ.get('X509_USER_CERT'), 'ssl_version': ssl.PROTOCOL_TLSv1_2 }
-        try:
-            host = '%s:%s' % (self.src['host'], self.src['port'])
-            self.logger.info('AMQP connecting to host={} as userid={}'.format(host, self.config['AMQP_USERID']))
-            conn = amqp.Connection(login_method='AMQPLAIN', host=host, virtual_host='xsede',
+        self.logger.info('AMQP connecting to host={} as userid={}'.format(host, self.config['AMQP_USERID']))
+        import amqp
+        conn = amqp.Connection(login_method='AMQPLAIN', host=host, virtual_host='xsede',
                                userid=self.config['AMQP_USERID'], password=self.config['AMQP_PASSWORD'],
                                heartbeat=120,
+                               connect_timeout=self.amqp_connect_timeout,
                                ssl=ssl_opts)
-            conn.connect()
-            return conn
-        except Exception as err:
-            self.logger.error('AMQP connect to primary error: ' + format(err))
+        conn.connect()
+        return conn
 
-        alternate = self.config.get('AMQP_FALLBACK', None)
-        if not alternate:
-            self.logger.error('No AMQP_FALLBACK, quitting...')
-            sys.exit(1)
+    def ConnectAmqp_UserPass(self):
+        # Race connections to the primary and AMQP_FALLBACK brokers, each bounded by AMQP_CONNECT_TIMEOUT
+        #   The primary wins if it connects within AMQP_PRIMARY_GRACE seconds of the fallback; raises
+        #   ConnectionError when neither connects
+        if self.failback_conn:
+            (conn, self.failback_conn) = (self.failback_conn, None)
+            if not self.amqp_primary:
+                self.amqp_connected('primary', '%s:%s' % (self.src['host'], self.src['port']))
+                return conn
+            self.amqp_close_quietly(conn)
+        brokers = [('primary', '%s:%s' % (self.src['host'], self.src['port']))]
+        if self.altsrc['host']:
+            brokers.append(('fallback', '%s:%s' % (self.altsrc['host'], self.altsrc['port'])))
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(brokers))
+        futures = {pool.submit(self.amqp_connect, host): (name, host) for (name, host) in brokers}
+        pool.shutdown(wait=False)
 
-        idx = alternate.find(':')
-        if idx > 0:
-            (self.altsrc['type'], self.altsrc['obj']) = (alternate[0:idx], alternate[idx+1:])
-        else:
-            self.altsrc['type'] = alternate
-        if self.altsrc['type'] == 'dir':
-            self.altsrc['type'] = 'directory'
-        elif self.altsrc['type'] not in ['amqp']:
-            self.logger.error('Alternate source not {amqp}')
-            sys.exit(1)
-        idx = self.altsrc['obj'].find(':')
-        if idx > 0:
-            (self.altsrc['host'], self.altsrc['port']) = (self.altsrc['obj'][0:idx], self.altsrc['obj'][idx+1:])
-        else:
-            self.altsrc['host'] = self.altsrc['obj']
-        if not self.altsrc['port']:
-            self.altsrc['port'] = '5671'
-        self.altsrc['display'] = '%s@%s:%s' % (self.altsrc['type'], self.altsrc['host'], self.altsrc['port'])
+        winner = None
+        pending = set(futures)
+        while pending and not (winner and winner[0] == 'primary'):
+            timeout = max(0, grace_until - time()) if winner else None
+            (done, pending) = concurrent.futures.wait(pending, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break   # The fallback won and the primary missed its grace period
+            for future in done:
+                (name, host) = futures[future]
+                try:
+                    conn = future.result()
+                except Exception as err:
+                    self.logger.error('AMQP connect to {} host={} error: {}'.format(name, host, err))
+                    continue
+                if winner is None or name == 'primary':
+                    if winner:
+                        self.amqp_close_quietly(winner[2])
+                    winner = (name, host, conn)
+                    grace_until = time() + self.amqp_primary_grace
+                else:
+                    self.amqp_close_quietly(conn)
+        # Attempts still running are closed if and when they connect
+        for future in pending:
+            future.add_done_callback(lambda f: f.exception() or self.amqp_close_quietly(f.result()))
+        if not winner:
+            raise ConnectionError('AMQP connect to {} failed'.format(' and '.join(name for (name, host) in brokers)))
+        self.amqp_connected(winner[0], winner[1])
+        return winner[2]
 
+    def amqp_connected(self, name, host):
+        self.logger.info('AMQP connected to {} host={}'.format(name, host))
+        metrics.inc('route_amqp_connects_total', broker=name)
+        self.amqp_primary = name == 'primary'
+        self.failback_at = time() + self.failback_seconds
+
+    def amqp_close_quietly(self, conn):
         try:
-            host = '%s:%s' % (self.altsrc['host'], self.altsrc['port'])
-            self.logger.info('AMQP connecting to host={} as userid={}'.format(host, self.config['AMQP_USERID']))
-            conn = amqp.Connection(login_method='AMQPLAIN', host=host, virtual_host='xsede',
-                               userid=self.config['AMQP_USERID'], password=self.config['AMQP_PASSWORD'],
-                               heartbeat=120,
-                               ssl=ssl_opts)
-            conn.connect()
-            return conn
+            conn.close()
+        except Exception:
+            pass
+
+    def amqp_failback_check(self):
+        # While on the fallback, probe the primary in the background and leave once it connects
+        if self.amqp_primary or not self.failback_seconds:
+            if self.failback_conn:
+                # A probe that finished after a reconnect had already reached the primary
+                (conn, self.failback_conn) = (self.failback_conn, None)
+                self.amqp_close_quietly(conn)
+            return
+        if self.failback_conn:
+            raise AmqpFailback('AMQP primary broker is back, failing back')
+        if self.failback_probe is None and time() >= self.failback_at:
+            self.failback_probe = threading.Thread(target=self.amqp_failback_probe, name='amqp-failback', daemon=True)
+            self.failback_probe.start()
+
+    def amqp_failback_probe(self):
+        host = '%s:%s' % (self.src['host'], self.src['port'])
+        try:
+            conn = self.amqp_connect(host)
+            if self.amqp_primary:
+                # Reconnected to the primary while this probe was connecting
+                self.amqp_close_quietly(conn)
+            else:
+                self.failback_conn = conn
         except Exception as err:
-            self.logger.error('AMQP connect to alternate error: ' + format(err))
-            self.logger.error('Quitting...')
-            sys.exit(1)
+            self.logger.warning('AMQP primary host={} still unavailable: {}'.format(host, err))
+        finally:
+            self.failback_at = time() + self.failback_seconds
+            self.failback_probe = None
+
+    def amqp_disconnected(self, err):
+        # Log why consuming stopped and close the connection, ready for amqp_reconnect
+        if isinstance(err, AmqpFailback):
+            self.logger.warning(format(err))
+        else:
+            self.logger.error('AMQP drain_events error: ' + format(err))
+            metrics.inc('route_errors_total', stage='amqp')
+        self.amqp_close_quietly(self.conn)
+        self.amqp_disconnected_at = time()
+        # Failing back, or losing a connection that stayed up a while, reconnects at once; quick repeated
+        #   losses keep backing off so a flapping broker is not hammered
+        if isinstance(err, AmqpFailback) or \
+                (self.amqp_connected_at and time() - self.amqp_connected_at >= self.amqp_backoff.maximum):
+            self.amqp_backoff.reset()
+
+    def amqp_reconnect_delay(self):
+        delay = self.amqp_backoff.next()
+        if delay:
+            self.logger.info('AMQP reconnecting in {:.1f}/seconds'.format(delay))
+        return delay
+
+    def amqp_reconnect_failed(self, err):
+        self.logger.error('AMQP consume setup error: ' + format(err))
+        metrics.inc('route_errors_total', stage='amqp_connect')
+
+    def amqp_reconnected(self):
+        self.amqp_connected_at = time()
+        if self.amqp_disconnected_at:
+            metrics.observe('route_amqp_connect_seconds', self.amqp_connected_at - self.amqp_disconnected_at)
+            self.amqp_disconnected_at = None
+
+    def amqp_reconnect(self):
+        # Connect and set up consuming, retrying with backoff for as long as it takes
+        while True:
+            sleep(self.amqp_reconnect_delay())
+            try:
+                self.amqp_consume_setup()
+            except Exception as err:
+                self.amqp_reconnect_failed(err)
+                continue
+            self.amqp_reconnected()
+            return
+
+    async def amqp_async_reconnect(self):
+        # amqp_reconnect for the asyncio engine, connecting on a thread so the loop keeps running
+        import asyncio
+        while True:
+            await asyncio.sleep(self.amqp_reconnect_delay())
+            try:
+                await self.loop.run_in_executor(None, self.amqp_consume_setup)
+            except Exception as err:
+                self.amqp_reconnect_failed(err)
+                continue
+            self.amqp_reconnected()
+            return
 
     def ConnectAmqp_X509(self):
         ssl_opts = {'ca_certs': self.config['X509_CACERTS'],
                    'keyfile': '/path/to/key.pem',
                    'certfile': '/path/to/cert.pem'}
+        import amqp
         return amqp.Connection(login_method='EXTERNAL', host='%s:%s' % (self.src['host'], self.src['port']), virtual_host='xsede',
                                ssl=ssl_opts)
 
     def src_amqp(self):
         return
 
-    def dest_print(self, st, doctype, resourceid, message_body):
-        print('{} exchange={}, routing_key={}, size={}, dest=PRINT'.format(st, doctype, resourceid, len(message_body) ) )
-        if self.dest['obj'] != 'dump':
+    def dest_print(self, msg):
+        print('{} exchange={}, routing_key={}, size={}, dest=PRINT'.format(msg.ts, msg.doctype, msg.resourceid, msg.size ) )
+        if self.dests['print']['obj'] != 'dump':
             return
         try:
-            py_data = json.loads(message_body)
+            py_data = msg.data
         except ValueError as e:
             self.logger.error('Parsing Exception: %s' % (e))
             return
         for key in py_data:
             print('  Key=' + key)
 
-    def dest_directory(self, st, doctype, resourceid, message_body):
-        dir = os.path.join(self.dest['obj'], doctype)
-        if not os.access(dir, os.W_OK):
-            self.logger.critical('%s exchange=%s, routing_key=%s, size=%s Directory not writable "%s"' %
-                  (st, doctype, resourceid, len(message_body), dir ) )
-            return
-        file_name = resourceid + '.' + st
-        file = os.path.join(dir, file_name)
-        self.logger.info('%s exchange=%s, routing_key=%s, size=%s dest=file:<exchange>/%s' %
-                  (st, doctype, resourceid, len(message_body), file_name ) )
-        with open(file, 'w') as fd:
-            fd.write(message_body)
-            fd.close()
-
-    def dest_restapi(self, st, doctype, resourceid, message_body):
-        global response, data
-        if doctype not in ['inca','nagios']:
-            self.logger.debug('exchange=%s, routing_key=%s, size=%s dest=DROP' %
-                  (doctype, resourceid, len(message_body) ) )
-            return
-
-        if doctype in ['inca']:
-            data = json.loads(message_body)
-            if 'rep:report' in data:
-                self.logger.debug('exchange=%s, routing_key=%s, size=%s discarding old format' %
-                      (doctype, resourceid, len(message_body) ) )
-                return
+    def log_fields(self, msg):
+        # Structured fields for JsonLogFormatter
+        return {'exchange': msg.doctype, 'routing_key': msg.resourceid, 'size': msg.size}
 
-            try:
-                resourceid = data['TestResult']['Associations']['ResourceID']
-            except:
-                self.logger.error('exchange=%s, routing_key=%s, size=%s missing Associations->ResourceID' %
-                                  (doctype, resourceid, len(message_body) ) )
-                return
-
-        elif doctype in ['nagios']:
-            data = json.loads(message_body)
-            try:
-                resourceid = data['TestResult']['Associations']['ResourceID']
-            except:
-                self.logger.error('exchange=%s, routing_key=%s, size=%s missing Associations->ResourceID' %
-                                  (doctype, resourceid, len(message_body) ) )
+    def dest_directory(self, msg):
+        dir = os.path.join(self.dests['directory']['obj'], msg.doctype)
+        if dir not in self.writable_dirs:
+            if not os.access(dir, os.W_OK):
+                self.logger.critical('%s exchange=%s, routing_key=%s, size=%s Directory not writable "%s"' %
+                      (msg.ts, msg.doctype, msg.resourceid, msg.size, dir ) )
                 return
+            self.writable_dirs.add(dir)
+        if self.archive:
+            file_name = self.archive.write(msg)
+            self.msglog.info('%s exchange=%s, routing_key=%s, size=%s dest=segment:<exchange>/%s',
+                             msg.ts, msg.doctype, msg.resourceid, msg.size, file_name, extra=self.log_fields(msg))
+            return
+        file_name = msg.resourceid + '.' + msg.ts
+        file = os.path.join(dir, file_name)
+        self.msglog.info('%s exchange=%s, routing_key=%s, size=%s dest=file:<exchange>/%s',
+                         msg.ts, msg.doctype, msg.resourceid, msg.size, file_name, extra=self.log_fields(msg))
+        with open(file, 'wb') as fd:
+            fd.write(msg.body if isinstance(msg.body, bytes) else msg.body.encode('utf-8'))
 
-        headers = {'Content-type': 'application/json',
-            'Authorization': 'Basic %s' % base64.standard_b64encode( (self.config['API_USERID'] + ':' + self.config['API_PASSWORD']).encode() ).decode() }
-        url = '/monitoring-provider-api/v1/process/doctype/%s/resourceid/%s/' % (doctype, resourceid)
-        if self.dest['host'] not in ['localhost', '127.0.0.1'] and self.dest['port'] != '8000':
-            url = '/wh1' + url
-        (host, port) = (self.dest['host'], self.dest['port'])
+    def dest_restapi(self, msg):
+        url = self.restapi_url(msg)
+        if not url:
+            return
+        (host, port) = (self.dests['api']['host'], self.dests['api']['port'])
+        status = None
         retries = 0
         while retries < 100:
             try:
-                if self.dest['port'] == '443':
-    #                ssl_con = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, capath='/etc/grid-security/certificates/')
-    #                ssl_con.load_default_certs()
-    #                ssl_con.load_cert_chain('certkey.pem')
-                    ssl_con = ssl._create_unverified_context(check_hostname=False, \
-                                                             certfile=self.config['X509_CERT'], keyfile=self.config['X509_KEY'])
-                    conn = httplib.HTTPSConnection(host, port, context=ssl_con)
-                else:
-                    conn = httplib.HTTPConnection(host, port)
-                self.logger.debug('POST %s' % url)
-                conn.request('POST', url, message_body, headers)
-                response = conn.getresponse()
-                self.logger.info('RESP exchange=%s, routing_key=%s, size=%s dest=POST http_response=status(%s)/reason(%s)' %
-                    (doctype, resourceid, len(message_body), response.status, response.reason ) )
-                data = response.read()
-                conn.close()
+                status = self.post_restapi(msg, url)
                 retries = 0 # Success, reset retries
                 break
             except (socket.error) as e:
                 retries += 1
+                metrics.inc('route_retries_total', destination='api')
                 sleepminutes = 2*retries
                 self.logger.error('Exception socket.error to %s:%s; sleeping %s/minutes before retrying' % \
                                   (host, port, sleepminutes))
                 sleep(sleepminutes*60)
             except (httplib.BadStatusLine) as e:
                 retries += 1
+                metrics.inc('route_retries_total', destination='api')
                 sleepminutes = 2*retries
                 self.logger.error('Exception httplib.BadStatusLine to %s:%s; sleeping %s/minutes before retrying' % \
                                   (host, port, sleepminutes))
                 sleep(sleepminutes*60)
 
-        if response.status in [400, 403]:
+        if status is None:
+            metrics.inc('route_dropped_total', reason='retries_exhausted')
+            self.logger.error('Giving up POST to %s:%s after %s retries' % (host, port, retries))
+
+    def restapi_url(self, msg):
+        # The API URL to POST the message to, or None to drop it
+        (doctype, resourceid) = (msg.doctype, msg.resourceid)
+        if doctype not in ['inca','nagios']:
+            self.msglog.debug('exchange=%s, routing_key=%s, size=%s dest=DROP', doctype, resourceid, msg.size)
+            metrics.inc('route_dropped_total', reason='doctype')
+            return None
+
+        if doctype in ['inca']:
+            data = msg.data
+            if 'rep:report' in data:
+                self.msglog.debug('exchange=%s, routing_key=%s, size=%s discarding old format', \
+                                  doctype, resourceid, msg.size)
+                metrics.inc('route_dropped_total', reason='old_format')
+                return None
+
+            try:
+                resourceid = data['TestResult']['Associations']['ResourceID']
+            except:
+                self.logger.error('exchange=%s, routing_key=%s, size=%s missing Associations->ResourceID' %
+                                  (doctype, resourceid, msg.size ) )
+                metrics.inc('route_dropped_total', reason='no_resourceid')
+                return None
+
+        elif doctype in ['nagios']:
+            data = msg.data
+            try:
+                resourceid = data['TestResult']['Associations']['ResourceID']
+            except:
+                self.logger.error('exchange=%s, routing_key=%s, size=%s missing Associations->ResourceID' %
+                                  (doctype, resourceid, msg.size ) )
+                metrics.inc('route_dropped_total', reason='no_resourceid')
+                return None
+
+        url = '/monitoring-provider-api/v1/process/doctype/%s/resourceid/%s/' % (doctype, resourceid)
+        if self.dests['api']['host'] not in ['localhost', '127.0.0.1'] and self.dests['api']['port'] != '8000':
+            url = '/wh1' + url
+        return url
+
+    def post_restapi(self, msg, url):
+        # One POST attempt, raising on connection errors; returns the HTTP status
+        self.msglog.debug('POST %s', url)
+        body = msg.body if isinstance(msg.body, bytes) else msg.body.encode('utf-8')
+        start = time()
+        status = None
+        if self.api_gzip_bytes and len(body) >= self.api_gzip_bytes:
+            compressed = gzip.compress(body, compresslevel=self.api_gzip_level)
+            (status, reason, data) = self.api_pool.request('POST', url, compressed, {'Content-Encoding': 'gzip'})
+            if status == 415:
+                self.logger.warning('API does not accept gzip Content-Encoding, sending uncompressed from now on')
+                (self.api_gzip_bytes, status) = (0, None)
+            else:
+                metrics.inc('route_api_bytes_total', len(compressed), encoding='gzip')
+        if status is None:
+            (status, reason, data) = self.api_pool.request('POST', url, body)
+            metrics.inc('route_api_bytes_total', len(body), encoding='identity')
+        metrics.observe('route_destination_seconds', time() - start, destination='api')
+        if status < 400:
+            report_lag(msg, 'api')
+        else:
+            metrics.inc('route_errors_total', stage='api_status_{}'.format(status))
+        self.msglog.info('RESP exchange=%s, routing_key=%s, size=%s dest=POST http_response=status(%s)/reason(%s)',
+                         msg.doctype, msg.resourceid, msg.size, status, reason, extra=self.log_fields(msg))
+        if status in [400, 403]:
             self.logger.error('response=%s' % data)
-            return
+            return status
         try:
-            obj = json.loads(data)
+            obj = json_loads(data)
         except ValueError as e:
             self.logger.error('API response not in expected format (%s)' % e)
+        return status
+
+    def spool_restapi(self, msgs):
+        for msg in msgs:
+            try:
+                msg.data
+            except ValueError as e:
+                # Retrying can't help, and would hold up everything spooled after it
+                self.logger.error('Parsing spooled exchange=%s routing_key=%s Exception: %s' % (msg.doctype, msg.resourceid, e))
+                metrics.inc('route_dropped_total', reason='parse')
+                continue
+            url = self.restapi_url(msg)
+            if not url:
+                continue
+            status = self.post_restapi(msg, url)
+            if status >= 500:
+                raise httplib.HTTPException('HTTP status {}'.format(status))
 
-    def dest_warehouse(self, ts, doctype, resourceid, message_body):
-        proc = Glue2ProcessRawMonitoring(application=os.path.basename(__file__), function='dest_warehouse')
-        (code, message) = proc.process(ts, doctype, resourceid, message_body)
+    def spool_warehouse(self, msgs):
+        # Retrying a message the warehouse rejects can't help, and would hold up everything spooled after it
+        self.warehouse_batcher.write(msgs, drop_failed=True)
+
+    def dest_warehouse(self, msg):
+        # Completed when its batch commits
+        self.warehouse_batcher.add(msg)
+
+    def warehouse_committed(self, tokens):
+        for token in tokens:
+            self.tracker.complete(token)
 
     def process_file(self, path):
         file_name = path.split('/')[-1]
-        if file_name[0] == '.':
+        if file_name[0] == '.' or file_name.endswith(ARCHIVE_INDEX_SUFFIX) or file_name.endswith(ARCHIVE_OPEN_SUFFIX):
+            return
+        if file_name.endswith(ARCHIVE_SUFFIX):
+            self.process_archive(path)
             return
         
         idx = file_name.rfind('.')
         resourceid = file_name[0:idx]
         ts = file_name[idx+1:len(file_name)]
-        with open(path, 'r') as file:
-            data=file.read().replace('\n','')
-            file.close()
+        size = os.path.getsize(path)
+        if self.max_message_bytes and size > self.max_message_bytes:
+            # Copied aside without reading it in
+            self.quarantine(Message(ts, os.path.basename(os.path.dirname(path)), resourceid, None), path=path, size=size)
+            return
+        with open(path, 'rb') as file:
+            data=file.read()
+        msg = Message(ts, None, resourceid, data)
         try:
-            py_data = json.loads(data)
-        except ValueError as e:
-            self.logger.error('Parsing "%s" Exception: %s' % (path, e))
+            py_data = msg.data
+        except ValueError:
+            # Tolerate documents with newlines inside JSON strings
+            msg = Message(ts, None, resourceid, data.replace(b'\n',b''))
+            try:
+                py_data = msg.data
+            except ValueError as e:
+                self.logger.error('Parsing "%s" Exception: %s' % (path, e))
+                metrics.inc('route_dropped_total', reason='parse')
+                return
+        if not self.classify_message(msg, path):
+            return
+        if not self.rules.accept(msg.doctype, msg.resourceid, msg.size):
+            self.msglog.debug('Excluded by rule: %s', path)
+            metrics.inc('route_dropped_total', reason='rule')
             return
+        self.msglog.info('Processing file: %s', path)
+        self.route_file_message(msg)
+
+    def process_archive(self, path):
+        self.msglog.info('Processing archive: %s', path)
+        for record in read_archive(path):
+            msg = Message(record['ts'], record['exchange'], record['routing_key'], record['body'])
+            if not self.rules.accept(msg.doctype, msg.resourceid, msg.size):
+                metrics.inc('route_dropped_total', reason='rule')
+                continue
+            if self.max_message_bytes and msg.size > self.max_message_bytes:
+                self.quarantine(msg)
+                continue
+            try:
+                msg.data
+            except ValueError as e:
+                self.logger.error('Parsing "%s" record ts=%s Exception: %s' % (path, msg.ts, e))
+                metrics.inc('route_dropped_total', reason='parse')
+                continue
+            if self.classify_message(msg, path):
+                self.route_file_message(msg)
 
+    def classify_message(self, msg, path):
+        # Set the doctype, and resourceid for test results, from the document content
+        py_data = msg.data
         if 'ApplicationEnvironment' in py_data or 'ApplicationHandle' in py_data:
-            doctype = 'glue2.applications'
+            msg.doctype = 'glue2.applications'
         elif 'ComputingManager' in py_data or 'ComputingService' in py_data or \
             'ExecutionEnvironment' in py_data or 'Location' in py_data or 'ComputingShare' in py_data:
-            doctype = 'glue2.compute'
+            msg.doctype = 'glue2.compute'
         elif 'ComputingActivity' in py_data:
-            doctype = 'glue2.computing_activities'
+            msg.doctype = 'glue2.computing_activities'
         elif 'TestResult' in py_data:
-            doctype = py_data['TestResult']['Extension']['Source'].lower()
-            resourceid = py_data['TestResult']['Associations']['ResourceID']
+            msg.doctype = py_data['TestResult']['Extension']['Source'].lower()
+            msg.resourceid = py_data['TestResult']['Associations']['ResourceID']
         else:
             self.logger.error('Document type not recognized: ' + path)
-            return
-        self.logger.info('Processing file: ' + path)
+            metrics.inc('route_dropped_total', reason='doctype')
+            return False
+        return True
 
-        if self.dest['type'] == 'api':
-            self.dest_restapi(ts, doctype, resourceid, data)
-        elif self.dest['type'] == 'warehouse':
-            self.dest_warehouse(ts, doctype, resourceid, data)
-        elif self.dest['type'] == 'print':
-            self.dest_print(ts, doctype, resourceid, data)
+    def route_file_message(self, msg):
+        # Replays go to the fan-out sinks in turn, there are no acknowledgements to wait for
+        for dest_type in [self.dest['type']] + [sink.destination for sink in self.sinks]:
+            metrics.inc('route_messages_total', exchange=msg.doctype, destination=dest_type)
+            if dest_type == 'api':
+                self.dest_restapi(msg)
+            elif dest_type == 'warehouse':
+                self.dest_warehouse(msg)
+            elif dest_type == 'print':
+                self.dest_print(msg)
 
     # Where we process
     def amqp_callback(self, message):
+        (exchange, routing_key) = (message.delivery_info['exchange'], message.delivery_info['routing_key'])
+        if not self.rules.accept(exchange, routing_key, len(message.body)):
+            self.msglog.debug('exchange=%s, routing_key=%s excluded by rule, dest=DROP', exchange, routing_key)
+            metrics.inc('route_dropped_total', reason='rule')
+            self.tracker.complete(self.tracker.receive(message.delivery_tag))
+            return
         st = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        doctype = message.delivery_info['exchange']
-        tag = message.delivery_tag
-        resourceid = message.delivery_info['routing_key']
-        if self.dest['type'] == 'print':
-            self.dest_print(st, doctype, resourceid, message.body)
-        elif self.dest['type'] == 'directory':
-            self.dest_directory(st, doctype, resourceid, message.body)
-        elif self.dest['type'] == 'warehouse':
-            self.dest_warehouse(st, doctype, resourceid, message.body)
-        elif self.dest['type'] == 'api':
-            self.dest_restapi(st, doctype, resourceid, message.body)
-        self.channel.basic_ack(delivery_tag=tag)
+        msg = Message(st, message.delivery_info['exchange'], message.delivery_info['routing_key'], message.body, \
+                      token=self.tracker.receive(message.delivery_tag))
+        if self.max_message_bytes and msg.size > self.max_message_bytes:
+            self.quarantine(msg)
+            self.tracker.complete(msg.token)
+            return
+        if self.coalescer:
+            superseded = self.coalescer.add(self.coalesce_key(msg), msg)
+            if superseded:
+                self.msglog.debug('exchange=%s, routing_key=%s superseded, dest=DROP', msg.doctype, msg.resourceid)
+                metrics.inc('route_dropped_total', reason='superseded')
+                self.tracker.complete(superseded.token)
+        else:
+            self.dispatch_message(msg)
         self.message_count += 1
+        metrics.inc('route_messages_total', exchange=msg.doctype, destination=self.dest['type'])
+
+    def quarantine(self, msg, path=None, size=None):
+        # Keep an oversized message out of the destinations, saving it (or copying its file) to QUARANTINE_DIR if set
+        size = msg.size if size is None else size
+        metrics.inc('route_quarantined_total', exchange=msg.doctype)
+        top = self.config.get('QUARANTINE_DIR')
+        if not top:
+            self.logger.error('exchange=%s, routing_key=%s, size=%s over MAX_MESSAGE_BYTES, dest=DROP', \
+                              msg.doctype, msg.resourceid, size)
+            return
+        dir = os.path.join(top, msg.doctype or 'unknown')
+        file = os.path.join(dir, '{}.{}'.format(msg.resourceid, msg.ts))
+        try:
+            os.makedirs(dir, exist_ok=True)
+            (base, count) = (file, 0)
+            while os.path.exists(file):
+                count += 1
+                file = '{}_{}'.format(base, count)
+            if path:
+                shutil.copyfile(path, file)
+            else:
+                with open(file, 'wb') as fd:
+                    fd.write(msg.body if isinstance(msg.body, bytes) else msg.body.encode('utf-8'))
+        except OSError as e:
+            self.logger.error('Quarantining to {}: {}'.format(file, e))
+            return
+        self.logger.warning('exchange=%s, routing_key=%s, size=%s over MAX_MESSAGE_BYTES, dest=quarantine:%s', \
+                            msg.doctype, msg.resourceid, size, file)
+
+    def coalesce_key(self, msg):
+        test_result = msg.test_result()
+        return (msg.doctype, msg.resourceid, test_result.get('Name') if test_result else None)
+
+    def dispatch_message(self, msg):
+        if self.dedup and not self.dedup.forward(msg):
+            self.msglog.debug('exchange=%s, routing_key=%s unchanged, dest=DROP', msg.doctype, msg.resourceid)
+            metrics.inc('route_dropped_total', reason='unchanged')
+            self.tracker.complete(msg.token)
+            return
+        for sink in self.sinks:
+            metrics.inc('route_messages_total', exchange=msg.doctype, destination=sink.destination)
+            if sink.required:
+                self.tracker.expect(msg.token, 1)
+            sink.put(msg)
+        if self.loop:
+            # Chain each message behind the previous one for its routing key so they stay in order
+            previous = self.async_tails.get(msg.resourceid)
+            task = self.loop.create_task(self.route_async(msg, previous))
+            self.async_tails[msg.resourceid] = task
+            task.add_done_callback(lambda task, key=msg.resourceid: \
+                                   self.async_tails.pop(key) if self.async_tails.get(key) is task else None)
+        elif self.workers:
+            # Messages for one routing key always go to the same worker so they stay in order
+            worker = self.workers[hash(msg.resourceid) % len(self.workers)]
+            worker.submit(self.route_worker, msg)
+        else:
+            self.route_message(msg)
+
+    def route_message(self, msg):
+        if self.spool:
+            # Completed once the spool has it on disk
+            self.spool.append(msg)
+            return
+        self.deliver(self.dest['type'], msg)
+
+    def deliver(self, dest_type, msg):
+        start = time()
+        if dest_type == 'print':
+            self.dest_print(msg)
+        elif dest_type == 'directory':
+            self.dest_directory(msg)
+            metrics.observe('route_destination_seconds', time() - start, destination='directory')
+        elif dest_type == 'warehouse':
+            # Completed when its batch commits
+            self.dest_warehouse(msg)
+            return
+        elif dest_type == 'api':
+            self.dest_restapi(msg)
+        if msg.token is not None:
+            self.tracker.complete(msg.token)
+
+    def sink_error(self, e):
+        # Raised on the AMQP thread by amqp_housekeeping() so the channel is reset and messages redelivered
+        self.worker_error = e
+
+    def warehouse_sink_housekeeping(self):
+        if self.warehouse_batcher.due():
+            self.warehouse_batcher.flush()
 
-        self.warehouse_expire()
+    def route_worker(self, msg):
+        try:
+            self.route_message(msg)
+        except Exception as e:
+            # Raised on the AMQP thread by amqp_housekeeping() so the channel is reset and messages redelivered
+            metrics.inc('route_errors_total', stage='worker')
+            self.worker_error = e
+
+    async def route_async(self, msg, previous):
+        if previous:
+            import asyncio
+            await asyncio.wait([previous])
+        async with self.inflight:
+            try:
+                await self.loop.run_in_executor(self.async_executor, self.route_message, msg)
+            except Exception as e:
+                metrics.inc('route_errors_total', stage='worker')
+                self.worker_error = e
+        if not self.worker_error:
+            self.ack_ready()
+
+    def coalesce_release(self):
+        if self.coalescer:
+            for msg in self.coalescer.expired():
+                self.dispatch_message(msg)
+
+    def amqp_drain(self):
+        # Wait for and handle incoming frames, raising socket.timeout when there are none
+        if not self.wake:
+            start = time()
+            self.conn.drain_events(timeout=self.drain_timeout())
+            metrics.observe('route_drain_seconds', time() - start)
+            return
+        # Also wake up when a worker or sink completes a message, so it's acknowledged at once
+        (readable, _, _) = select.select([self.conn.sock, self.wake[0]], [], [], self.drain_timeout())
+        if self.wake[0] in readable:
+            try:
+                self.wake[0].recv(4096)
+            except BlockingIOError:
+                pass
+        if self.conn.sock not in readable:
+            raise socket.timeout()
+        # Read every complete frame, including any the SSL layer has already buffered, up to a prefetch window
+        for i in range(self.prefetch):
+            start = time()
+            self.conn.drain_events(timeout=0)
+            metrics.observe('route_drain_seconds', time() - start)
+
+    def amqp_wake(self):
+        try:
+            self.wake[1].send(b'\0')
+        except BlockingIOError:
+            pass    # Already plenty of wake-ups waiting
+
+    def ack_ready(self):
+        tag = self.tracker.ackable()
+        if tag is not None:
+            start = time()
+            self.channel.basic_ack(delivery_tag=tag, multiple=True)
+            metrics.observe('route_ack_seconds', time() - start)
+        if self.coalescer:
+            # Held messages would otherwise hold back the acknowledgement of everything received after them
+            for tag in self.tracker.ackable_singly():
+                start = time()
+                self.channel.basic_ack(delivery_tag=tag, multiple=False)
+                metrics.observe('route_ack_seconds', time() - start)
+
+    def amqp_housekeeping(self):
+        self.conn.heartbeat_tick()
+        if self.worker_error:
+            (err, self.worker_error) = (self.worker_error, None)
+            raise err
+        self.coalesce_release()
+        self.warehouse_flush_due()
+        if 'directory' in self.dests and self.archive:
+            self.archive.rotate_due()
+        for spool in self.spools:
+            if spool.sync_due() or (spool.unsynced_count and self.tracker.outstanding() >= self.prefetch):
+                # Or at once when the broker will send nothing more until these are acknowledged
+                spool.sync()
+        self.ack_ready()
+        self.amqp_failback_check()
 
     def amqp_consume_setup(self):
-        now = datetime.utcnow()
+        self.conn = self.ConnectAmqp_UserPass()
         try:
-            if (now - self.amqp_consume_setup_last).seconds < 300:  # 5 minutes
-                self.logger.error('Too recent amqp_consume_setup, quitting...')
-                sys.exit(1)
-        except SystemExit:
+            self.amqp_channel_setup()
+        except Exception:
+            # Each retry connects afresh, so don't leave this connection open
+            self.amqp_close_quietly(self.conn)
             raise
-        except:
-            pass
-        self.amqp_consume_setup_last = now
 
-        self.conn = self.ConnectAmqp_UserPass()
+    def amqp_channel_setup(self):
         self.channel = self.conn.channel()
-        self.channel.basic_qos(prefetch_size=0, prefetch_count=4, a_global=True)
+        # Keep bodies as the bytes received rather than decoding them to str
+        self.channel.auto_decode = False
+        self.tracker.reset()
+        if self.coalescer:
+            self.coalescer.reset()
+        if self.dedup:
+            # Results cached before a failure may not have been written, so forward everything again
+            self.dedup.clear()
+        for sink in self.sinks:
+            sink.clear()
+        prefetch = self.args.prefetch or int(self.config.get('PREFETCH', 4))
+        if 'warehouse' in self.dests:
+            # Unacknowledged batched messages count against prefetch, so allow at least a full batch
+            self.warehouse_batcher.reset()
+            prefetch = max(prefetch, self.warehouse_batcher.max_count)
+        if self.coalescer:
+            # Held messages stay unacknowledged for the window, so allow one per key likely to be held at once
+            prefetch = max(prefetch, int(self.config.get('COALESCE_PREFETCH', 1000)))
+        if self.engine == 'asyncio':
+            # Every in-flight destination call holds an unacknowledged message
+            prefetch = max(prefetch, int(self.config.get('API_INFLIGHT', 16)))
+        for sink in self.sinks:
+            if sink.required and not sink.spool:
+                # A message is acknowledged only once every required sink has it, so allow a slow sink's full
+                #   buffer, and the message it is delivering, while the other destinations carry on
+                prefetch = max(prefetch, sink.buffer.maxsize + 1)
+        for spool in self.spools:
+            # Messages are acknowledged once fsync'ed, so allow a full fsync batch
+            prefetch = max(prefetch, spool.fsync_count)
+        self.prefetch = prefetch
+        self.channel.basic_qos(prefetch_size=0, prefetch_count=prefetch, a_global=True)
         which_queue = self.args.queue or self.config.get('QUEUE', 'monitoring-router')
-        queue = self.channel.queue_declare(queue=which_queue, durable=True, auto_delete=False).queue
         exchanges = ['inca','nagios']
-        for ex in exchanges:
-            self.channel.queue_bind(queue, ex, '#')
-        self.logger.info('AMQP Queue={}, Exchanges=({})'.format(which_queue, ', '.join(exchanges)))
+        # Narrower bindings when the routing rules exclude an exchange or by default; a '#' binding left by an earlier
+        #   run is removed, other bindings from earlier rules must be removed by hand
+        bindings = self.rules.bindings(exchanges)
+        if self.shard is None:
+            queue = self.channel.queue_declare(queue=which_queue, durable=True, auto_delete=False).queue
+            for ex in exchanges:
+                if (ex, '#') not in bindings:
+                    self.channel.queue_unbind(queue, ex, '#')
+            for (ex, key) in bindings:
+                self.channel.queue_bind(queue, ex, key)
+        else:
+            # A consistent-hash exchange (rabbitmq_consistent_hash_exchange plugin) bound to the source exchanges
+            #   spreads routing keys over equally weighted shard queues, so each resource's results stay in order
+            #   on one shard. Delete the highest numbered shard queues when reducing shards.
+            shard_exchange = self.config.get('SHARD_EXCHANGE', which_queue + '.shards')
+            # Nothing consumes the unsharded queue any more, so stop it collecting messages. Messages already in
+            #   it are left for a later unsharded run, or to be purged by hand.
+            unsharded = self.channel.queue_declare(queue=which_queue, durable=True, auto_delete=False)
+            for (ex, key) in [(ex, '#') for ex in exchanges] + [pair for pair in bindings if pair[1] != '#']:
+                self.channel.queue_unbind(unsharded.queue, ex, key)
+            if unsharded.message_count:
+                self.logger.warning('AMQP Queue={} is not consumed with SHARDS={} and still holds {} messages'.format( \
+                                    which_queue, self.shards, unsharded.message_count))
+            self.channel.exchange_declare(shard_exchange, 'x-consistent-hash', durable=True, auto_delete=False)
+            for ex in exchanges:
+                if (ex, '#') not in bindings:
+                    self.channel.exchange_unbind(shard_exchange, ex, '#')
+            for (ex, key) in bindings:
+                self.channel.exchange_bind(shard_exchange, ex, key)
+            which_queue = '{}.shard{}'.format(which_queue, self.shard)
+            queue = self.channel.queue_declare(queue=which_queue, durable=True, auto_delete=False).queue
+            self.channel.queue_bind(queue, shard_exchange, '1')
+            exchanges = [shard_exchange]
+        self.logger.info('AMQP Queue={}, Exchanges=({}), Bindings=({})'.format(which_queue, ', '.join(exchanges), \
+                         ', '.join('{}:{}'.format(ex, key) for (ex, key) in bindings)))
         st = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
         self.channel.basic_consume(queue, callback=self.amqp_callback)
     
     def Run(self):
-        if self.args.expire:
-            self.expirer = Glue2DeleteExpiredMonitoring(interval = 3600)
-        
         self.wake_processed = 0
+        if self.src['type'] == 'amqp' and self.shards and self.shard is None:
+            return self.supervise()
         if self.src['type'] == 'amqp':
-            self.amqp_consume_setup()
+            if self.args.expire:
+                self.expirer = ExpireThread(interval=int(self.config.get('EXPIRE_INTERVAL', 3600)))
+                self.expirer.start()
+            self.worker_error = None
+            nworkers = self.args.workers
+            if nworkers is None:
+                nworkers = int(self.config.get('WORKERS', 0))
+            self.workers = [concurrent.futures.ThreadPoolExecutor(max_workers=1) for i in range(nworkers)]
+            if self.workers:
+                self.logger.info('AMQP message workers={}'.format(nworkers))
+            # Workers and sinks complete messages on their own threads, and wake the AMQP thread to acknowledge them
+            self.wake = None
+            if (self.workers or self.sinks) and self.engine == 'threads':
+                self.wake = socket.socketpair()
+                for sock in self.wake:
+                    sock.setblocking(False)
+            self.tracker = DeliveryTracker(on_done=self.amqp_wake if self.wake else None)
+            window = float(self.config.get('COALESCE_SECONDS', 0))
+            self.coalescer = Coalescer(window) if window > 0 else None
+            if self.coalescer:
+                self.logger.info('Coalescing superseded results within {}/seconds'.format(window))
+            refresh = float(self.config.get('DEDUP_REFRESH_SECONDS', 0))
+            self.dedup = None
+            if refresh > 0:
+                self.dedup = DedupCache(refresh, max_entries=int(self.config.get('DEDUP_MAX_ENTRIES', 100000)), \
+                                        volatile=self.config.get('DEDUP_VOLATILE_KEYS', r'(Time|Timestamp|Date)$'))
+                self.logger.info('Skipping unchanged results for up to {} seconds'.format(refresh))
+            self.spool = None
+            self.spools = []
+            if self.config.get('SPOOL_DIR') and self.dest['type'] in ['api', 'warehouse']:
+                self.spool = self.spool_setup(self.dest['type'], self.config['SPOOL_DIR'])
+            for sink in self.sinks:
+                if sink.destination not in ['api', 'warehouse']:
+                    sink.start()
+                elif self.config.get('SPOOL_DIR'):
+                    # Its own spool, so while this destination is down the others carry on
+                    sink.spool = self.spool_setup(sink.destination, \
+                                                  os.path.join(self.config['SPOOL_DIR'], 'sink-' + sink.destination))
+                else:
+                    self.logger.warning('Fan-out {} without SPOOL_DIR: while it is down its buffer fills and then '
+                                        'holds up the other destinations'.format(sink.destination))
+                    sink.start()
             self.message_count = 0
+            self.loop = None
+            if self.engine == 'asyncio':
+                import asyncio
+                asyncio.run(self.amqp_async_run())
+                return
+            self.amqp_reconnect()
             while True:
                 try:
-                    save_count = copy.copy(self.message_count)
-                    self.conn.drain_events(timeout=15)
-                    self.conn.heartbeat_tick()
-                    if save_count == self.message_count:
-                        sleep(5)
-                    continue # Loops back to the while
-                except (socket.timeout):
-                    self.logger.debug('AMQP drain_events timeout, heartbeat_tick')
-                    self.conn.heartbeat_tick()
-                    sleep(5)
+                    full = self.spool_full()
+                    if full:
+                        # Backpressure: stop consuming until the drainer frees spool space
+                        full.wait_for_space(1)
+                    else:
+                        try:
+                            self.amqp_drain()
+                        except (socket.timeout):
+                            pass
+                    self.amqp_housekeeping()
                     continue # Loops back to the while
                 except Exception as err:
-                    self.logger.error('AMQP drain_events error: ' + format(err))
-                try:
-                    self.conn.close()
-                except Exception as err:
-                    self.logger.error('AMQP connection.close error: ' + format(err))
-                sleep(30)   # Sleep a little and then try to reconnect
-                self.amqp_consume_setup()
+                    self.amqp_disconnected(err)
+                self.amqp_reconnect()
 
         elif self.src['type'] == 'file':
             self.src['obj'] = os.path.abspath(self.src['obj'])
@@ -508,29 +2546,380 @@ class Router():
                 self.logger.error('Source is not a readable file=%s' % self.src['obj'])
                 sys.exit(1)
             self.process_file(self.src['obj'])
+            self.warehouse_flush()
 
         elif self.src['type'] == 'directory':
             self.src['obj'] = os.path.abspath(self.src['obj'])
             if not os.path.isdir(self.src['obj']):
                 self.logger.error('Source is not a readable directory=%s' % self.src['obj'])
                 sys.exit(1)
-            for file1 in os.listdir(self.src['obj']):
-                fullfile1 = os.path.join(self.src['obj'], file1)
-                if os.path.isfile(fullfile1):
-                    self.process_file(fullfile1)
-                elif os.path.isdir(fullfile1):
-                    for file2 in os.listdir(fullfile1):
-                        fullfile2 = os.path.join(fullfile1, file2)
-                        if os.path.isfile(fullfile2):
-                            self.process_file(fullfile2)
-
-    def warehouse_expire(self):
-        if self.args.expire:
-            (code, message) = self.expirer.delete()
-            if not code:
-                self.logger.error('Expirer reported: {}'.format(message))
-            elif message:
-                self.logger.info('Expirer reported: {}'.format(message))
+            if self.args.watch or self.config.get('WATCH', False):
+                self.watch_directory(self.src['obj'])
+            else:
+                self.replay_directory(self.src['obj'])
+
+    def replay_directory(self, top):
+        global _replay_router
+        processes = self.args.processes
+        if processes is None:
+            processes = int(self.config.get('REPLAY_PROCESSES', 0))
+        chunk_size = int(self.config.get('REPLAY_CHUNK_FILES', 100))
+        checkpoint = ReplayCheckpoint(self.args.checkpoint or self.config.get('REPLAY_CHECKPOINT'))
+        progress = ReplayProgress(interval=int(self.config.get('REPLAY_PROGRESS_SECONDS', 10)))
+        self.logger.info('Replaying directory={} processes={} checkpoint={} completed={}'.format( \
+                         top, processes, checkpoint.path, len(checkpoint.done)))
+
+        def chunks():
+            chunk = []
+            for (path, size) in scan_files(top):
+                if path in checkpoint:
+                    progress.skipped += 1
+                    continue
+                chunk.append((path, size))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def completed(result):
+            (processed, failed) = result
+            checkpoint.add([path for (path, size) in processed])
+            progress.add(len(processed), sum(size for (path, size) in processed))
+            progress.failed += failed
+
+        if processes <= 1:
+            for chunk in chunks():
+                try:
+                    result = self.replay_chunk(chunk)
+                except Exception as e:
+                    self.replay_failed(chunk, progress, e)
+                    continue
+                completed(result)
+        else:
+            # Children inherit the router through fork; they must not share its sockets or DB connection
+            import multiprocessing
+            _replay_router = self
+            self.logging_synchronous()
+            if 'api' in self.dests:
+                self.api_pool.close()
+            if 'warehouse' in self.dests:
+                db_connection.close()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, \
+                                                        mp_context=multiprocessing.get_context('fork')) as pool:
+                running = {}
+                for chunk in chunks():
+                    running[pool.submit(_replay_chunk, chunk)] = chunk
+                    if len(running) >= 2 * processes:   # Keep the scan only a little ahead of the workers
+                        self.replay_collect(running, completed, progress, concurrent.futures.FIRST_COMPLETED)
+                self.replay_collect(running, completed, progress, concurrent.futures.ALL_COMPLETED)
+        checkpoint.close()
+        progress.report(final=True)
+
+    def replay_collect(self, running, completed, progress, return_when):
+        (done, not_done) = concurrent.futures.wait(running, return_when=return_when)
+        for future in done:
+            chunk = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                self.replay_failed(chunk, progress, e)
+                continue
+            completed(result)
+
+    def replay_failed(self, chunk, progress, e):
+        # Not checkpointed, so a later run retries these files
+        progress.failed += len(chunk)
+        self.logger.error('Replay of {} files starting with {} failed: {}: {}'.format( \
+                          len(chunk), chunk[0][0], type(e).__name__, e))
+
+    def replay_chunk(self, chunk):
+        # Process a chunk of files and commit any batched warehouse writes before they are checkpointed
+        #   Returns the files processed and the number that failed; a failed file is left out of the
+        #   checkpoint, so a later run retries it without repeating the rest of its chunk
+        processed = []
+        for (path, size) in chunk:
+            try:
+                self.process_file(path)
+            except Exception as e:
+                metrics.inc('route_errors_total', stage='replay')
+                self.logger.error('Replay of file={} failed: {}: {}'.format(path, type(e).__name__, e))
+                continue
+            processed.append((path, size))
+        self.warehouse_flush()
+        return (processed, len(chunk) - len(processed))
+
+    def watch_directory(self, top):
+        # Follow a directory, processing each file as soon as it is completely written, in this process so
+        #   the destinations stay set up between files. Processed files are moved to WATCH_DONE_DIR, or else
+        #   recorded in the checkpoint, so they are never processed again. A file that fails is retried
+        #   when it is rewritten or the router restarts.
+        done_dir = self.config.get('WATCH_DONE_DIR')
+        checkpoint = ReplayCheckpoint(self.args.checkpoint or self.config.get('REPLAY_CHECKPOINT'))
+        if done_dir:
+            done_dir = os.path.abspath(done_dir)
+            if done_dir == top or done_dir.startswith(top + '/'):
+                self.logger.error('WATCH_DONE_DIR must be outside the source directory')
+                sys.exit(1)
+        elif not checkpoint.path:
+            self.logger.warning('Watch without WATCH_DONE_DIR or a checkpoint only remembers processed files until exit')
+        ignore = lambda name: name.startswith('.') or name.endswith(ARCHIVE_INDEX_SUFFIX) or name.endswith(ARCHIVE_OPEN_SUFFIX)
+        watcher = DirectoryWatcher(top, checkpoint.done, ignore=ignore,
+                                   poll=float(self.config.get('WATCH_POLL_SECONDS', 2)),
+                                   settle=float(self.config.get('WATCH_SETTLE_SECONDS', 5)))
+        self.logger.info('Watching directory={} using {}, done={}'.format(top, watcher.method, \
+                         done_dir or checkpoint.path or 'memory'))
+        try:
+            while True:
+                processed = []
+                for (path, size, mtime) in watcher.ready(timeout=15):
+                    try:
+                        self.process_file(path)
+                    except Exception as e:
+                        self.logger.error('Watch processing file={} failed: {}: {}'.format(path, type(e).__name__, e))
+                        continue
+                    processed.append((path, mtime))
+                if not processed:
+                    continue
+                # Batched warehouse writes are committed before their files count as done
+                self.warehouse_flush()
+                for (path, mtime) in processed:
+                    metrics.observe('route_watch_lag_seconds', time() - mtime)
+                    self.watch_completed(watcher, path, done_dir, checkpoint)
+        finally:
+            watcher.close()
+            checkpoint.close()
+
+    def watch_completed(self, watcher, path, done_dir, checkpoint):
+        if done_dir:
+            target = os.path.join(done_dir, os.path.relpath(path, watcher.top))
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+                watcher.completed(path, remember=False)
+                return
+            except OSError as e:
+                self.logger.error('Watch moving file={} to {} failed, recording it as done: {}'.format(path, target, e))
+        checkpoint.add([path])
+        watcher.completed(path)
+
+    async def amqp_async_run(self):
+        # Consume on the event loop: the AMQP socket is drained when readable, heartbeats and acks run on
+        #   the loop, and up to API_INFLIGHT destination calls run concurrently on a thread pool
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        inflight = int(self.config.get('API_INFLIGHT', 16))
+        self.inflight = asyncio.Semaphore(inflight)
+        self.async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=inflight)
+        self.async_tails = {}
+        self.logger.info('AMQP asyncio engine, in-flight limit={}'.format(inflight))
+        while True:
+            await self.amqp_async_reconnect()
+            try:
+                fd = self.conn.sock.fileno()
+                self.loop.add_reader(fd, self.amqp_async_readable)
+                self.async_reading = True
+                try:
+                    while True:
+                        self.amqp_housekeeping()
+                        if not self.async_reading and not self.spool_full():
+                            self.loop.add_reader(fd, self.amqp_async_readable)
+                            self.async_reading = True
+                        await asyncio.sleep(min(1, self.drain_timeout()))
+                finally:
+                    self.loop.remove_reader(fd)
+            except Exception as err:
+                self.amqp_disconnected(err)
+
+    def amqp_async_readable(self):
+        # Read every complete frame, including any the SSL layer has already buffered
+        try:
+            while not self.worker_error:
+                if self.spool_full():
+                    # Backpressure: stop reading until the drainer frees spool space
+                    self.loop.remove_reader(self.conn.sock.fileno())
+                    self.async_reading = False
+                    return
+                self.conn.drain_events(timeout=0)
+        except socket.timeout:
+            pass
+        except Exception as e:
+            self.worker_error = e
+
+    def spool_setup(self, dest_type, path):
+        # A spool in path for an api or warehouse destination, with a drainer delivering from it
+        spool = Spool(path, self.spool_durable, \
+                      max_bytes=int(self.config.get('SPOOL_MAX_BYTES', 1<<30)), \
+                      segment_bytes=int(self.config.get('SPOOL_SEGMENT_BYTES', 64<<20)), \
+                      fsync_count=int(self.config.get('SPOOL_FSYNC_COUNT', 100)), \
+                      fsync_seconds=float(self.config.get('SPOOL_FSYNC_SECONDS', 0.2)))
+        if dest_type == 'api':
+            (send, batch) = (self.spool_restapi, 1)
+        else:
+            (send, batch) = (self.spool_warehouse, self.warehouse_batcher.max_count)
+        SpoolDrainer(spool, send, dest_type, batch=batch, \
+                     backoff_max=int(self.config.get('SPOOL_BACKOFF_MAX', 300))).start()
+        self.spools.append(spool)
+        self.logger.info('Spooling {} to {} ({} bytes spooled)'.format(dest_type, spool.path, spool.bytes))
+        return spool
+
+    def spool_full(self):
+        # The first full spool, or None
+        for spool in self.spools:
+            if spool.full():
+                return spool
+        return None
+
+    def supervise(self):
+        # Run and restart the shard consumer processes, keeping a combined status file in RUN_DIR
+        self.logger.info('Supervising shards={}'.format(self.shards))
+        self.shard_states = [{'shard': i, 'pid': None, 'started': None, 'restarts': 0, 'last_exit': None, \
+                              'restart_at': 0, 'backoff': 1} for i in range(self.shards)]
+        name = os.path.basename(__file__).replace('.py', '')
+        status_path = os.path.join(self.config['RUN_DIR'], '{}.status'.format(name)) if self.config.get('RUN_DIR') else None
+        status_written = 0
+        try:
+            while True:
+                changed = False
+                for state in self.shard_states:
+                    if state['pid'] is None and time() >= state['restart_at']:
+                        self.shard_start(state)
+                        changed = True
+                try:
+                    (pid, status) = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    (pid, status) = (0, 0)
+                if pid:
+                    self.shard_exited(pid, status)
+                    changed = True
+                if status_path and (changed or time() - status_written >= 60):
+                    self.shard_status_write(status_path)
+                    status_written = time()
+                if not pid:
+                    sleep(1)
+        finally:
+            self.shard_stop_all()
+            if status_path:
+                self.shard_status_write(status_path)
+
+    def shard_start(self, state):
+        pid = os.fork()
+        if pid:
+            state.update(pid=pid, started=time())
+            self.logger.info('Started shard={} pid={}'.format(state['shard'], pid))
+            return
+        rc = 1
+        try:
+            rc = self.shard_run(state['shard'])
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            self.logger.error('Shard={} {} Exception: {}'.format(state['shard'], type(e).__name__, e))
+        finally:
+            # Never return into the supervisor's stack, or run its PidFile cleanup
+            self.archive_close()
+            self.logging_stop()
+            logging.shutdown()
+            sys.stdout.flush()
+            os._exit(rc or 0)
+
+    def shard_run(self, shard):
+        # In a forked shard: log, spool, archive and report metrics separately from the other shards
+        self.shard = shard
+        suffix = '.shard{}'.format(shard)
+        (root, ext) = os.path.splitext(self.config['LOG_FILE'])
+        self.logger.removeHandler(self.handler)
+        self.handler = logging.handlers.TimedRotatingFileHandler(root + suffix + ext, when='W6', backupCount=999, utc=True)
+        self.handler.setFormatter(self.formatter)
+        self.logger.addHandler(self.handler)
+        self.logging_setup()
+        self.logger.info('Starting shard={} of {} pid={}'.format(shard, self.shards, os.getpid()))
+        if self.config.get('SPOOL_DIR'):
+            self.config['SPOOL_DIR'] = os.path.join(self.config['SPOOL_DIR'], 'shard{}'.format(shard))
+        if getattr(self, 'archive', None):
+            self.archive.tag = 's{}-'.format(shard)
+            self.archive.recover()
+        # Expired records are deleted in exactly one place
+        if shard != 0:
+            self.args.expire = False
+        self.metrics_setup(suffix=suffix, port_offset=shard + 1)
+        return self.Run()
+
+    def shard_exited(self, pid, status):
+        for state in self.shard_states:
+            if state['pid'] != pid:
+                continue
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            ran = time() - state['started']
+            # Restart promptly after a long run, backing off while a shard keeps failing quickly
+            state['backoff'] = 1 if ran >= 300 else min(state['backoff'] * 2, 300)
+            state.update(pid=None, last_exit=code, restart_at=time() + state['backoff'])
+            state['restarts'] += 1
+            metrics.inc('route_shard_restarts_total', shard=state['shard'])
+            self.logger.error('Shard={} pid={} exited with rc={} after {:.0f}/seconds, restarting in {}/seconds'.format( \
+                              state['shard'], pid, code, ran, state['backoff']))
+
+    def shard_stop_all(self, timeout=30):
+        running = {state['pid']: state for state in self.shard_states if state['pid']}
+        for pid in running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time() + timeout
+        while running and time() < deadline:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                running.pop(pid, {})['pid'] = None
+            else:
+                sleep(0.2)
+        for pid in running:
+            self.logger.error('Shard pid={} did not stop, killing it'.format(pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            running[pid]['pid'] = None
+
+    def shard_status_write(self, path):
+        status = {'pid': os.getpid(), 'started': self.started, 'updated': time(), 'shards': \
+                  [{key: state[key] for key in ['shard', 'pid', 'started', 'restarts', 'last_exit']} \
+                   for state in self.shard_states]}
+        try:
+            with open(path + '.tmp', 'w') as file:
+                json.dump(status, file, indent=2)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.error('Writing status file {}: {}'.format(path, e))
+
+    def spool_durable(self, tokens):
+        for token in tokens:
+            self.tracker.complete(token)
+
+    def drain_timeout(self):
+        timeout = 15
+        if (self.workers or self.sinks) and not self.wake and self.tracker.outstanding():
+            timeout = 0.05  # Wake up promptly to acknowledge messages completed by the workers
+        if self.coalescer:
+            timeout = min(timeout, max(0.05, self.coalescer.seconds_until_due()))
+        for spool in self.spools:
+            if spool.unsynced_count:
+                timeout = min(timeout, spool.fsync_seconds)
+        if self.dest['type'] == 'warehouse':
+            timeout = min(timeout, max(0.05, self.warehouse_batcher.seconds_until_due()))
+        return timeout
+
+    def warehouse_flush_due(self):
+        if self.dest['type'] == 'warehouse' and self.warehouse_batcher.due():
+            self.warehouse_batcher.flush()
+
+    def warehouse_flush(self):
+        if 'warehouse' in self.dests:
+            self.warehouse_batcher.flush()
 
 ########## CUSTOMIZATIONS END ##########
 
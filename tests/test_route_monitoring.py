@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+
+# Unit tests for bin/route_monitoring.py reconnection, acknowledgement and spool logic
+#   Run from the top directory with: python3 -m unittest discover tests  (or: python3 -m pytest tests)
+#   No broker, API or warehouse is needed, broker connections are replaced with fakes
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+from time import sleep, time
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+sys.path.insert(0, BIN_DIR)
+from route_monitoring import AmqpFailback, Backoff, DeliveryTracker, Message, Router, RoutingRules, Spool, topic_regex
+
+class FakeConnection():
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def amqp_router(connect_delays, fallback=True, grace=0.5, failback_seconds=300):
+    # A Router with only the AMQP connection settings, whose amqp_connect() takes connect_delays[host]
+    #   seconds to return a FakeConnection, or raises ConnectionError when the delay is None
+    router = Router.__new__(Router)
+    router.logger = logging.getLogger('DaemonLog')
+    router.src = {'host': 'primary.example.org', 'port': 5671}
+    router.altsrc = {'host': 'fallback.example.org' if fallback else None, 'port': 5671}
+    router.amqp_primary_grace = grace
+    router.failback_seconds = failback_seconds
+    router.amqp_primary = True
+    router.failback_conn = None
+    router.failback_probe = None
+    router.failback_at = 0
+    router.connections = []
+
+    def amqp_connect(host):
+        delay = connect_delays[host.split('.')[0]]
+        if delay is None:
+            sleep(0.05)
+            raise ConnectionError('refused')
+        sleep(delay)
+        conn = FakeConnection(host)
+        router.connections.append(conn)
+        return conn
+    router.amqp_connect = amqp_connect
+    return router
+
+class TestConnectAmqpUserPass(unittest.TestCase):
+    def test_primary_wins_race(self):
+        router = amqp_router({'primary': 0.05, 'fallback': 0.2})
+        conn = router.ConnectAmqp_UserPass()
+        self.assertEqual(conn.host, 'primary.example.org:5671')
+        self.assertTrue(router.amqp_primary)
+        # The losing fallback attempt is closed once it connects
+        sleep(0.3)
+        self.assertEqual([c.host for c in router.connections if c.closed], ['fallback.example.org:5671'])
+
+    def test_primary_within_grace_beats_fallback(self):
+        router = amqp_router({'primary': 0.3, 'fallback': 0.05}, grace=1)
+        conn = router.ConnectAmqp_UserPass()
+        self.assertEqual(conn.host, 'primary.example.org:5671')
+        self.assertTrue(router.amqp_primary)
+        self.assertEqual([c.host for c in router.connections if c.closed], ['fallback.example.org:5671'])
+
+    def test_fallback_wins_after_grace(self):
+        router = amqp_router({'primary': 0.6, 'fallback': 0.05}, grace=0.1)
+        started = time()
+        conn = router.ConnectAmqp_UserPass()
+        self.assertLess(time() - started, 0.5)
+        self.assertEqual(conn.host, 'fallback.example.org:5671')
+        self.assertFalse(router.amqp_primary)
+        self.assertFalse(conn.closed)
+        # The late primary connection is closed rather than leaked
+        sleep(0.7)
+        self.assertEqual([c.host for c in router.connections if c.closed], ['primary.example.org:5671'])
+
+    def test_fallback_when_primary_fails(self):
+        router = amqp_router({'primary': None, 'fallback': 0.1})
+        conn = router.ConnectAmqp_UserPass()
+        self.assertEqual(conn.host, 'fallback.example.org:5671')
+        self.assertFalse(router.amqp_primary)
+
+    def test_both_fail(self):
+        router = amqp_router({'primary': None, 'fallback': None})
+        with self.assertRaises(ConnectionError):
+            router.ConnectAmqp_UserPass()
+
+    def test_primary_only(self):
+        router = amqp_router({'primary': None}, fallback=False)
+        with self.assertRaises(ConnectionError):
+            router.ConnectAmqp_UserPass()
+        router = amqp_router({'primary': 0}, fallback=False)
+        self.assertEqual(router.ConnectAmqp_UserPass().host, 'primary.example.org:5671')
+
+    def test_failback(self):
+        router = amqp_router({'primary': None, 'fallback': 0}, failback_seconds=0.1)
+        conn = router.ConnectAmqp_UserPass()
+        self.assertFalse(router.amqp_primary)
+        # No probe before AMQP_FAILBACK_SECONDS, and a failed probe leaves us on the fallback
+        router.amqp_failback_check()
+        self.assertIsNone(router.failback_probe)
+        sleep(0.15)
+        router.amqp_failback_check()
+        router.failback_probe.join()
+        router.amqp_failback_check()
+        self.assertIsNone(router.failback_conn)
+        # Once the primary answers the next check fails back, and the reconnect reuses the probe's connection
+        router.amqp_connect = amqp_router({'primary': 0, 'fallback': 0}).amqp_connect
+        sleep(0.15)
+        router.amqp_failback_check()
+        router.failback_probe.join()
+        with self.assertRaises(AmqpFailback):
+            router.amqp_failback_check()
+        probed = router.failback_conn
+        self.assertEqual(router.ConnectAmqp_UserPass(), probed)
+        self.assertEqual(probed.host, 'primary.example.org:5671')
+        self.assertTrue(router.amqp_primary)
+        self.assertIsNone(router.failback_conn)
+        # Back on the primary there is nothing to probe
+        router.amqp_failback_check()
+        self.assertIsNone(router.failback_probe)
+        self.assertFalse(conn.closed)
+
+class Stop(BaseException):
+    # Ends Run()'s consume loop, which reconnects after any Exception
+    pass
+
+class FlappingBroker():
+    # A fake primary and fallback broker sharing one queue of messages
+    #   A message stays queued until acknowledged, so one delivered on a lost connection is delivered again.
+    #   refuse[name] connect attempts to a broker fail and bad_channels channel() calls raise. A connection
+    #   drops right after delivering its drop_after'th message, before it can be acknowledged, and calls
+    #   on_drop(). deliverable(conn) holds back deliveries, and drain_events() raises Stop once every
+    #   message is acknowledged.
+    def __init__(self, count):
+        self.queued = list(range(1, count + 1))
+        self.refuse = {'primary': 0, 'fallback': 0}
+        self.bad_channels = 0
+        self.drop_after = None
+        self.on_drop = lambda: None
+        self.on_ack = lambda: None
+        self.deliverable = lambda conn: True
+        self.connections = []
+
+    def connect(self, host):
+        name = host.split('.')[0]
+        if self.refuse[name]:
+            self.refuse[name] -= 1
+            raise ConnectionRefusedError('{} refused'.format(name))
+        conn = FlappingConnection(self, host)
+        self.connections.append(conn)
+        return conn
+
+class FlappingConnection():
+    # The connection and its channel
+    def __init__(self, broker, host):
+        self.broker = broker
+        self.host = host
+        self.closed = False
+        self.delivered = []     # Message numbers, in delivery tag order
+
+    def channel(self):
+        if self.broker.bad_channels:
+            self.broker.bad_channels -= 1
+            raise ConnectionError('channel open failed')
+        return self
+
+    def drain_events(self, timeout=None):
+        if not self.broker.queued:
+            raise Stop()
+        waiting = [n for n in self.broker.queued if n not in self.delivered]
+        if not waiting or not self.broker.deliverable(self):
+            sleep(0.01)
+            raise socket.timeout()
+        self.delivered.append(waiting[0])
+        body = json.dumps({'TestResult': {'ID': waiting[0]}})
+        self.callback(argparse.Namespace(delivery_tag=len(self.delivered), body=body, delivery_info={ \
+                      'exchange': 'nagios', 'routing_key': 'r{}.example.org'.format(waiting[0])}))
+        if self.broker.drop_after == len(self.delivered):
+            self.broker.drop_after = None
+            self.broker.on_drop()
+            raise ConnectionResetError('connection dropped')
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        acked = self.delivered[:delivery_tag] if multiple else [self.delivered[delivery_tag - 1]]
+        self.broker.queued = [n for n in self.broker.queued if n not in acked]
+        self.broker.on_ack()
+
+    def basic_consume(self, queue, callback=None):
+        self.callback = callback
+
+    def queue_declare(self, queue, **kwargs):
+        return argparse.Namespace(queue=queue, message_count=0, consumer_count=0)
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def queue_unbind(self, *args, **kwargs):
+        pass
+
+    def heartbeat_tick(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class TestRunReconnect(unittest.TestCase):
+    # Run()'s consume loop against a broker that drops connections and recovers
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='route_monitoring_test-')
+        os.makedirs(os.path.join(self.path, 'out', 'nagios'))
+        self.signals = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+        self.argv = sys.argv
+        self.router = None
+
+    def tearDown(self):
+        sys.argv = self.argv
+        for (signum, handler) in self.signals.items():
+            signal.signal(signum, handler)
+        if self.router:
+            logging.getLogger('DaemonLog').removeHandler(self.router.handler)
+            self.router.handler.close()
+        shutil.rmtree(self.path)
+
+    def run_router(self, broker, **config):
+        # Route to a directory until every message is acknowledged, returning the log
+        config.update({'LOG_FILE': os.path.join(self.path, 'route_monitoring.log'), 'LOG_LEVEL': 'info', \
+                       'LOG_ASYNC': False, 'AMQP_FALLBACK': 'amqp:fallback.example.org:5671', \
+                       'AMQP_BACKOFF_MAX': 0.2, 'AMQP_PRIMARY_GRACE': 0.2})
+        conf = os.path.join(self.path, 'route_monitoring.conf')
+        with open(conf, 'w') as file:
+            json.dump(config, file)
+        sys.argv = ['route_monitoring.py', '-c', conf, '-s', 'amqp:primary.example.org:5671', \
+                    '-d', 'directory:' + os.path.join(self.path, 'out')]
+        self.router = Router()
+        self.router.Setup()
+        self.router.amqp_connect = broker.connect
+        started = time()
+        with self.assertRaises(Stop):
+            self.router.Run()
+        self.assertLess(time() - started, 10)
+        with open(config['LOG_FILE']) as file:
+            return file.read()
+
+    def written(self):
+        # Routing keys written, a message delivered again may be written again under a later timestamp
+        return len(set(name.split('.')[0] for name in os.listdir(os.path.join(self.path, 'out', 'nagios'))))
+
+    def test_reconnect_after_drop(self):
+        broker = FlappingBroker(10)
+        broker.refuse['fallback'] = 10**6
+        broker.drop_after = 4
+        # After the drop the primary refuses one attempt, and then a channel fails to open
+        broker.on_drop = lambda: (broker.refuse.update(primary=1), setattr(broker, 'bad_channels', 1))
+        log = self.run_router(broker)
+        self.assertEqual(broker.queued, [])
+        self.assertEqual(self.written(), 10)
+        (first, failed, last) = broker.connections
+        self.assertTrue(first.closed)
+        # A connection whose channel setup failed is closed rather than leaked
+        self.assertTrue(failed.closed)
+        self.assertEqual(failed.delivered, [])
+        # The message unacknowledged when the connection dropped is delivered again
+        self.assertEqual(first.delivered, [1, 2, 3, 4])
+        self.assertEqual(last.delivered, [4, 5, 6, 7, 8, 9, 10])
+        self.assertFalse(last.closed)
+        self.assertTrue(self.router.amqp_primary)
+        self.assertIn('connection dropped', log)
+        self.assertIn('primary refused', log)
+        self.assertIn('channel open failed', log)
+        # Quick repeated losses keep backing off
+        self.assertEqual(self.router.amqp_backoff.attempt, 4)
+
+    def test_failback(self):
+        broker = FlappingBroker(10)
+        broker.refuse['primary'] = 10**6
+        # The fallback delivers three messages, then the primary comes back and delivers the rest
+        broker.deliverable = lambda conn: conn.host.startswith('primary') or len(conn.delivered) < 3
+        broker.on_ack = lambda: broker.refuse.update(primary=0) if len(broker.queued) == 7 else None
+        log = self.run_router(broker, AMQP_FAILBACK_SECONDS=0.1)
+        self.assertEqual(broker.queued, [])
+        self.assertEqual(self.written(), 10)
+        (fallback, primary) = broker.connections
+        self.assertEqual(fallback.host, 'fallback.example.org:5671')
+        self.assertTrue(fallback.closed)
+        self.assertEqual(fallback.delivered, [1, 2, 3])
+        self.assertEqual(primary.host, 'primary.example.org:5671')
+        self.assertFalse(primary.closed)
+        self.assertEqual(primary.delivered, [4, 5, 6, 7, 8, 9, 10])
+        self.assertTrue(self.router.amqp_primary)
+        self.assertIsNone(self.router.failback_conn)
+        self.assertIn('AMQP primary broker is back, failing back', log)
+        # Failing back resets the backoff, so it reconnects at once
+        self.assertEqual(self.router.amqp_backoff.attempt, 1)
+
+class TestTopicRegex(unittest.TestCase):
+    def matches(self, pattern, keys):
+        regex = topic_regex(pattern)
+        return [key for key in keys if regex.fullmatch(key)]
+
+    def test_star(self):
+        self.assertEqual(self.matches('*', ['a', 'a.b', '']), ['a'])
+        self.assertEqual(self.matches('a.*', ['a', 'a.b', 'a.b.c', 'b.c']), ['a.b'])
+        self.assertEqual(self.matches('*.b', ['a.b', 'x.b', 'b', 'a.x.b']), ['a.b', 'x.b'])
+
+    def test_hash(self):
+        self.assertEqual(self.matches('#', ['a', 'a.b.c', '']), ['a', 'a.b.c', ''])
+        self.assertEqual(self.matches('a.#', ['a', 'a.b', 'a.b.c', 'ab', 'b.a']), ['a', 'a.b', 'a.b.c'])
+
+    def test_repeated_hash(self):
+        keys = ['a', 'a.b', 'a.b.c', '']
+        self.assertEqual(self.matches('#.#', keys), self.matches('#', keys))
+        self.assertEqual(self.matches('a.#.#', keys + ['ab']), ['a', 'a.b', 'a.b.c'])
+
+    def test_hash_between_words(self):
+        self.assertEqual(self.matches('a.#.b', ['a.b', 'a.x.b', 'a.x.y.b', 'a.xb', 'ax.b', 'a.b.c']), \
+                         ['a.b', 'a.x.b', 'a.x.y.b'])
+
+    def test_literal_dots(self):
+        self.assertEqual(self.matches('r1.example.org', ['r1.example.org', 'r1xexample.org']), ['r1.example.org'])
+
+class TestRoutingRules(unittest.TestCase):
+    exchanges = ['inca', 'nagios']
+
+    def test_include_default(self):
+        self.assertEqual(RoutingRules([]).bindings(self.exchanges), [('inca', '#'), ('nagios', '#')])
+
+    def test_exclude_exchange(self):
+        # Excluded messages never reach the queue
+        rules = RoutingRules([{'ACTION': 'exclude', 'EXCHANGE': 'nagios'}])
+        self.assertEqual(rules.bindings(self.exchanges), [('inca', '#')])
+        self.assertFalse(rules.accept('nagios', 'r1', 10))
+        self.assertTrue(rules.accept('inca', 'r1', 10))
+
+    def test_include_ahead_of_exclude(self):
+        rules = RoutingRules([{'ACTION': 'include', 'EXCHANGE': 'nagios', 'ROUTING_KEY': 'a.#'},
+                              {'ACTION': 'exclude', 'EXCHANGE': 'nagios'}])
+        self.assertEqual(rules.bindings(self.exchanges), [('inca', '#'), ('nagios', 'a.#')])
+
+    def test_exclude_after_include_all(self):
+        rules = RoutingRules([{'ACTION': 'include'}, {'ACTION': 'exclude', 'EXCHANGE': 'nagios'}])
+        self.assertEqual(rules.bindings(self.exchanges), [('inca', '#'), ('nagios', '#')])
+
+    def test_conditional_exclude_keeps_binding(self):
+        for rule in [{'ACTION': 'exclude', 'EXCHANGE': 'nagios', 'ROUTING_KEY': 'a.#'},
+                     {'ACTION': 'exclude', 'EXCHANGE': 'nagios', 'RESOURCE': 'r1'},
+                     {'ACTION': 'exclude', 'EXCHANGE': 'nagios', 'MAX_BYTES': 100}]:
+            self.assertEqual(RoutingRules([rule]).bindings(self.exchanges), [('inca', '#'), ('nagios', '#')])
+
+    def test_exclude_default(self):
+        rules = RoutingRules([{'ACTION': 'include', 'EXCHANGE': 'inca', 'RESOURCE': ['r1', 'r2']},
+                              {'ACTION': 'include', 'ROUTING_KEY': '*.example.org'}], default='exclude')
+        self.assertEqual(rules.bindings(self.exchanges), \
+                         [('inca', 'r1'), ('inca', 'r2'), ('inca', '*.example.org'), ('nagios', '*.example.org')])
+        self.assertEqual(RoutingRules([], default='exclude').bindings(self.exchanges), [])
+
+class TestBackoff(unittest.TestCase):
+    def test_first_retry_is_immediate(self):
+        self.assertEqual(Backoff().next(), 0)
+
+    def test_exponential_with_jitter_and_maximum(self):
+        backoff = Backoff(base=1, maximum=8)
+        backoff.next()
+        for ceiling in (1, 2, 4, 8, 8, 8):
+            delay = backoff.next()
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+    def test_reset(self):
+        backoff = Backoff(base=1, maximum=60)
+        for _ in range(5):
+            backoff.next()
+        backoff.reset()
+        self.assertEqual(backoff.next(), 0)
+        self.assertLessEqual(backoff.next(), 1)
+
+class TestDeliveryTracker(unittest.TestCase):
+    def test_ordered_acks(self):
+        tracker = DeliveryTracker()
+        tokens = [tracker.receive(tag) for tag in (1, 2, 3, 4)]
+        tracker.complete(tokens[1])
+        tracker.complete(tokens[2])
+        self.assertIsNone(tracker.ackable())
+        tracker.complete(tokens[0])
+        self.assertEqual(tracker.ackable(), 3)
+        self.assertIsNone(tracker.ackable())
+        self.assertEqual(tracker.outstanding(), 1)
+        tracker.complete(tokens[3])
+        self.assertEqual(tracker.ackable(), 4)
+        self.assertEqual(tracker.outstanding(), 0)
+
+    def test_generation_reset(self):
+        tracker = DeliveryTracker()
+        old = [tracker.receive(tag) for tag in (1, 2, 3)]
+        tracker.complete(old[1])
+        # The channel is lost, the new one restarts delivery tags at 1
+        tracker.reset()
+        self.assertEqual(tracker.outstanding(), 0)
+        new = [tracker.receive(tag) for tag in (1, 2)]
+        self.assertNotEqual(old[0], new[0])
+        # Late completions from the old channel must not acknowledge the new channel's tags
+        tracker.complete(old[0])
+        tracker.complete(old[2])
+        self.assertIsNone(tracker.ackable())
+        self.assertEqual(tracker.ackable_singly(), [])
+        tracker.complete(new[1])
+        self.assertIsNone(tracker.ackable())
+        tracker.complete(new[0])
+        self.assertEqual(tracker.ackable(), 2)
+
+    def test_expect_more_completions(self):
+        tracker = DeliveryTracker()
+        token = tracker.receive(1)
+        tracker.expect(token, 2)
+        tracker.complete(token)
+        tracker.complete(token)
+        self.assertIsNone(tracker.ackable())
+        tracker.complete(token)
+        self.assertEqual(tracker.ackable(), 1)
+
+    def test_ackable_singly(self):
+        tracker = DeliveryTracker()
+        tokens = [tracker.receive(tag) for tag in (1, 2, 3)]
+        tracker.complete(tokens[2])
+        tracker.complete(tokens[1])
+        self.assertEqual(tracker.ackable_singly(), [2, 3])
+        self.assertEqual(tracker.ackable_singly(), [])
+        tracker.complete(tokens[0])
+        self.assertEqual(tracker.ackable(), 1)
+        self.assertEqual(tracker.outstanding(), 0)
+
+    def test_on_done(self):
+        done = []
+        tracker = DeliveryTracker(on_done=lambda: done.append(True))
+        token = tracker.receive(1)
+        tracker.reset()
+        tracker.complete(token)
+        self.assertEqual(done, [])
+        tracker.complete(tracker.receive(1))
+        self.assertEqual(done, [True])
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='route_monitoring_test-')
+        self.durable = []
+        self.spools = []
+
+    def tearDown(self):
+        for spool in self.spools:
+            spool.write_file.close()
+            if spool.read_file:
+                spool.read_file.close()
+        shutil.rmtree(self.path)
+
+    def spool(self, **kwargs):
+        spool = Spool(self.path, self.durable.extend, **kwargs)
+        self.spools.append(spool)
+        return spool
+
+    def message(self, n, token=None):
+        return Message(n, 'glue2.TestResult', 'resource{}'.format(n), '{{"n": {}}}'.format(n), token=token)
+
+    def bodies(self, msgs):
+        return [msg.body for msg in msgs]
+
+    def test_durable_batches(self):
+        spool = self.spool(fsync_count=3)
+        spool.append(self.message(1, token='a'))
+        spool.append(self.message(2, token='b'))
+        self.assertEqual(self.durable, [])
+        # Records are only read once they are synced
+        (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(msgs, [])
+        spool.append(self.message(3, token='c'))
+        self.assertEqual(self.durable, ['a', 'b', 'c'])
+        (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 1}', '{"n": 2}', '{"n": 3}'])
+        spool.append(self.message(4, token='d'))
+        spool.sync()
+        self.assertEqual(self.durable, ['a', 'b', 'c', 'd'])
+
+    def test_cursor(self):
+        spool = self.spool(fsync_count=1)
+        for n in range(5):
+            spool.append(self.message(n))
+        (msgs, position) = spool.read(2, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 0}', '{"n": 1}'])
+        # Reading again without a commit returns the same records
+        (msgs, position) = spool.read(2, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 0}', '{"n": 1}'])
+        spool.commit(position)
+        self.assertEqual(spool.position(), position)
+        with open(os.path.join(self.path, 'cursor')) as file:
+            self.assertEqual(file.read().split(), [str(field) for field in position])
+        (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 2}', '{"n": 3}', '{"n": 4}'])
+
+    def test_segments_deleted_once_drained(self):
+        spool = self.spool(fsync_count=1, segment_bytes=100)
+        for n in range(6):
+            spool.append(self.message(n))
+        segments = sorted(name for name in os.listdir(self.path) if name.endswith('.spool'))
+        self.assertGreater(len(segments), 2)
+        (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(len(msgs), 6)
+        spool.commit(position)
+        remaining = sorted(name for name in os.listdir(self.path) if name.endswith('.spool'))
+        self.assertEqual(remaining, [segments[-1]])
+        self.assertEqual(spool.bytes, os.path.getsize(os.path.join(self.path, segments[-1])))
+
+    def test_not_full_once_drained(self):
+        # SPOOL_MAX_BYTES below SPOOL_SEGMENT_BYTES
+        spool = self.spool(fsync_count=1, max_bytes=500, segment_bytes=64<<20)
+        while not spool.full():
+            spool.append(self.message(1))
+        (msgs, position) = spool.read(1000, timeout=0)
+        spool.commit(position)
+        self.assertFalse(spool.full())
+        self.assertLess(spool.bytes, spool.max_bytes)
+
+    def test_restart_recovery(self):
+        spool = self.spool(fsync_count=1)
+        for n in range(4):
+            spool.append(self.message(n))
+        (msgs, position) = spool.read(2, timeout=0)
+        spool.commit(position)
+        # A crash leaves a partial record after the last durable one
+        spool.write_file.write(b'\x00\x00\x00\x10\x00')
+        spool.write_file.flush()
+        spool = self.spool(fsync_count=1)
+        self.assertEqual(spool.position(), position)
+        spool.append(self.message(4))
+        # The partial record is skipped and reading continues in the new segment
+        with self.assertLogs('DaemonLog', level='WARNING'):
+            (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 2}', '{"n": 3}', '{"n": 4}'])
+        spool.commit(position)
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.spool')]), 1)
+
+    def test_restart_without_cursor(self):
+        # Nothing was committed yet, so a restart reads from the first segment
+        spool = self.spool(fsync_count=1)
+        spool.append(self.message(1))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'cursor')))
+        spool = self.spool(fsync_count=1)
+        (msgs, position) = spool.read(10, timeout=0)
+        self.assertEqual(self.bodies(msgs), ['{"n": 1}'])
+
+    def test_bytes_body(self):
+        spool = self.spool(fsync_count=1)
+        spool.append(Message(1, 'glue2.TestResult', 'resource', b'\x00binary'))
+        (msgs, position) = spool.read(1, timeout=0)
+        self.assertEqual(msgs[0].body, b'\x00binary')
+
+if __name__ == '__main__':
+    unittest.main()